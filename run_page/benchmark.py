@@ -0,0 +1,146 @@
+"""
+Time the polyline code paths against the ones they replaced, on the saved
+polylines of data.db and the longest GPX files
+"""
+
+import argparse
+import glob
+import os
+import time
+
+import polyline
+from config import GPX_FOLDER, SQL_FILE
+from generator.db import ActivityPolyline, decompress_polyline, init_db
+from gpxpy.geo import Location, simplify_polyline
+from gpxtrackposter.gpx_reader import read_gpx
+from polyline_codec import decode_many, encode_many
+from polyline_simplify import SIMPLIFY_MAX_DISTANCE
+
+
+def load_polylines(sql_file):
+    session = init_db(sql_file)
+    return [
+        decompress_polyline(data)
+        for (data,) in session.query(ActivityPolyline.polyline).filter(
+            ActivityPolyline.level == 0
+        )
+    ]
+
+
+def longest_gpx_files(gpx_dir, count):
+    file_names = glob.glob(os.path.join(gpx_dir, "**", "*.gpx"), recursive=True)
+    return sorted(file_names, key=os.path.getsize)[-count:]
+
+
+def best_of(repeat, func, *args):
+    """(seconds of the fastest of repeat calls of func(*args), its result)."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def report(name, before, after, identical):
+    print(
+        f"{name:<8} before {before * 1000:9.2f} ms   after {after * 1000:9.2f} ms"
+        f"   {before / after:6.1f}x   {'identical' if identical else 'DIFFERENT'}"
+    )
+
+
+def bench_codec(options):
+    """polyline.decode()/encode() one by one against decode_many()/encode_many()."""
+    polylines = load_polylines(options.db) * options.scale
+    print(
+        f"{len(polylines)} polylines, "
+        f"{sum(len(s) for s in polylines)} encoded characters"
+    )
+    before, points = best_of(
+        options.repeat, lambda: [polyline.decode(s) if s else [] for s in polylines]
+    )
+    after, (coords, offsets) = best_of(options.repeat, decode_many, polylines)
+    identical = [p for pl in points for p in pl] == list(map(tuple, coords.tolist()))
+    report("decode", before, after, identical)
+
+    before, encoded = best_of(
+        options.repeat, lambda: [polyline.encode(p) if p else "" for p in points]
+    )
+    after, encoded_many = best_of(options.repeat, encode_many, coords, offsets)
+    report("encode", before, after, encoded == encoded_many)
+
+
+def bench_simplify(options):
+    """gpxpy's simplify_polyline() against polyline_simplify.simplify()."""
+    file_names = longest_gpx_files(options.gpx_dir, options.files)
+    segments = [
+        s
+        for file_name in file_names * options.scale
+        for t in read_gpx(file_name).tracks
+        for s in t.segments
+    ]
+    print(
+        f"{len(segments)} segments of the {len(file_names)} longest GPX files, "
+        f"{sum(len(s) for s in segments)} points, {options.max_distance} m"
+    )
+    locations = [[Location(*p) for p in zip(s.lat, s.lon)] for s in segments]
+    before, simplified = best_of(
+        options.repeat,
+        lambda: [
+            simplify_polyline(points, options.max_distance) for points in locations
+        ],
+    )
+    after, kept = best_of(
+        options.repeat, lambda: [s.simplify(options.max_distance) for s in segments]
+    )
+    identical = all(
+        [points[i] for i in indices] == gpxpy_points
+        for points, indices, gpxpy_points in zip(locations, kept, simplified)
+    )
+    report("simplify", before, after, identical)
+
+
+BENCHMARKS = {
+    "codec": bench_codec,
+    "simplify": bench_simplify,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        metavar="BENCHMARK",
+        help=f"benchmarks to run ({', '.join(BENCHMARKS)}), all when none given",
+    )
+    parser.add_argument("--db", default=SQL_FILE, help="database to read from")
+    parser.add_argument(
+        "--gpx-dir", default=GPX_FOLDER, help="folder of the GPX files to simplify"
+    )
+    parser.add_argument(
+        "--files", type=int, default=20, help="number of the longest GPX files"
+    )
+    parser.add_argument(
+        "--max-distance",
+        type=float,
+        default=SIMPLIFY_MAX_DISTANCE,
+        help="simplify tolerance in meters",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="runs of every variant, the best counts"
+    )
+    parser.add_argument(
+        "--scale",
+        type=int,
+        default=1,
+        help="use the polylines (or GPX files) this many times over",
+    )
+    options = parser.parse_args()
+    unknown = set(options.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark {', '.join(sorted(unknown))}")
+
+    for name in options.benchmarks or BENCHMARKS:
+        print(f"\n{name}: {BENCHMARKS[name].__doc__}")
+        BENCHMARKS[name](options)
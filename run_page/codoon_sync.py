@@ -25,6 +25,7 @@ from config import (
     start_point,
 )
 from generator import Generator
+from track_metrics import heart_rate_stats
 from tzlocal import get_localzone
 from utils import adjust_time_to_utc, adjust_timestamp_to_utc, to_date
 
@@ -516,7 +517,7 @@ class Codoon:
         heart_rate_dict = run_data.get("heart_rate")
         heart_rate = None
         if heart_rate_dict:
-            heart_rate = sum(heart_rate_dict.values()) / len(heart_rate_dict)
+            heart_rate = heart_rate_stats(list(heart_rate_dict.values()))[0]
 
         polyline_str = polyline.encode(latlng_data) if latlng_data else ""
         start_latlng = start_point(*latlng_data[0]) if latlng_data else None
@@ -612,6 +613,4 @@ if __name__ == "__main__":
     tracks = j.get_old_tracks(old_tracks_ids, options.with_gpx, options.with_tcx)
 
     generator.sync_from_app(tracks)
-    activities_list = generator.load()
-    with open(JSON_FILE, "w") as f:
-        json.dump(activities_list, f, indent=0)
+    generator.write_activities_file(JSON_FILE)
@@ -22,13 +22,31 @@ SQL_FILE = os.path.join(parent, "run_page", "data.db")
 JSON_FILE = os.path.join(parent, "src", "static", "activities.json")
 SYNCED_FILE = os.path.join(parent, "imported.json")
 SYNCED_ACTIVITY_FILE = os.path.join(parent, "synced_activity.json")
+TRACK_CACHE_FILE = os.path.join(parent, "track_cache.json")
+TRACK_QUARANTINE_FILE = os.path.join(parent, "track_quarantine.json")
 NAME_MAPPING_FILE = os.path.join(FIT_FOLDER, "name_mapping.json")
+# cities and province outlines bundled with the front end
+CITY_FILE = os.path.join(parent, "src", "static", "city.ts")
+RUN_COUNTRIES_FILE = os.path.join(parent, "src", "static", "run_countries.ts")
 
 # TODO: Move into nike_sync NRC THINGS
 
 
 BASE_TIMEZONE = "Asia/Shanghai"
 
+# start points in the same S2 cell of this level share one reverse geocoding
+# result, level 16 cells are about 150m wide
+GEOCODE_CELL_LEVEL = int(os.getenv("GEOCODE_CELL_LEVEL", 16))
+# ask Nominatim for start points the offline geocoder has no city for
+GEOCODE_ONLINE = os.getenv("GEOCODE_ONLINE", False)
+# Nominatim allows one request per second
+GEOCODE_RATE = float(os.getenv("GEOCODE_RATE", 1))
+GEOCODE_WORKERS = int(os.getenv("GEOCODE_WORKERS", 2))
+
+# every saved polyline is also kept simplified to these tolerances in meters,
+# as levels 1, 2, ... of activity_polylines, the coarsest ones come last
+POLYLINE_LEVELS = [10, 50, 200, 1000]
+
 
 start_point = namedtuple("start_point", "lat lon")
 run_map = namedtuple("polyline", "summary_polyline")
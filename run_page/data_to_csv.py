@@ -17,8 +17,9 @@ def apply_duration_time(d):
         return ""
 
 
-# we do not need polyline in csv
-df = df.drop("summary_polyline", axis=1)
+# we do not need polyline in csv, nor moving_seconds, a copy of moving_time
+# (newer data.db keeps the polyline in activity_polylines)
+df = df.drop(["summary_polyline", "moving_seconds"], axis=1, errors="ignore")
 df["elapsed_time"] = df["elapsed_time"].apply(apply_duration_time)
 df["moving_time"] = df["moving_time"].apply(apply_duration_time)
 
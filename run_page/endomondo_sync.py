@@ -109,9 +109,7 @@ def run_enomondo_sync():
         track = parse_run_endomondo_to_nametuple(en_dict)
         tracks.append(track)
     generator.sync_from_app(tracks)
-    activities_list = generator.load()
-    with open(JSON_FILE, "w") as f:
-        json.dump(activities_list, f, indent=0)
+    generator.write_activities_file(JSON_FILE)
 
 
 if __name__ == "__main__":
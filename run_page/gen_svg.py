@@ -5,6 +5,7 @@ import sys
 
 import appdirs
 from config import SQL_FILE
+from generator.polyline_levels import coarsest_level
 from gpxtrackposter import (
     circular_drawer,
     github_drawer,
@@ -179,6 +180,14 @@ def main():
         action="store_true",
         help="activities db file",
     )
+    args_parser.add_argument(
+        "--polyline-tolerance",
+        dest="polyline_tolerance",
+        metavar="METERS",
+        type=float,
+        default=0,
+        help="with --from-db, draw the coarsest polylines no more than this off",
+    )
 
     for _, drawer in drawers.items():
         drawer.create_args(args_parser)
@@ -207,7 +216,10 @@ def main():
         # for svg from db here if you want gpx please do not use --from-db
         # args.type == "grid" means have polyline data or not
         tracks = loader.load_tracks_from_db(
-            SQL_FILE, args.type == "grid", args.type == "circular"
+            SQL_FILE,
+            args.type == "grid",
+            args.type == "circular",
+            coarsest_level(args.polyline_tolerance),
         )
     else:
         tracks = loader.load_tracks(args.gpx_dir)
@@ -7,15 +7,35 @@ import stravalib
 from config import MAPPING_TYPE
 from gpxtrackposter import track_loader
 from sqlalchemy import func
-
-from polyline_processor import filter_out
-
-from .db import Activity, init_db, update_or_create_activity
+from sqlalchemy.orm import selectinload
+
+from polyline_processor import filter_out, settings_digest
+
+from .db import (
+    Activity,
+    bulk_update_or_create_activities,
+    filter_out_cache,
+    geocode_cache,
+    init_db,
+    update_or_create_activity,
+)
+from .export import write_activities_file
+from .location_backfill import LocationBackfill
+from .rollup import ROLLUP_SCOPES, update_rollups, with_streaks
 
 from synced_data_file_logger import save_synced_data_file_list, load_fit_name_mapping
 
-
 IGNORE_BEFORE_SAVING = os.getenv("IGNORE_BEFORE_SAVING", False)
+# activities written to the database at once by sync_from_data_dir/sync_from_app
+SYNC_BATCH_SIZE = 500
+
+
+def _as_run_id(run_id):
+    """run_id as the int it is saved as, None when it can not be one."""
+    if isinstance(run_id, int):
+        return run_id
+    run_id = str(run_id)
+    return int(run_id) if run_id.isdigit() else None
 
 
 class Generator:
@@ -27,10 +47,14 @@ class Generator:
         self.client_secret = ""
         self.refresh_token = ""
         self.only_run = False
+        # known_run_ids() by source, None for all
+        self._known_run_ids = {}
 
     def update(self, sql):
         self.session.execute(sql)
+        update_rollups(self.session)
         self.session.commit()
+        self._known_run_ids.clear()
 
     def set_strava_config(self, client_id, client_secret, refresh_token):
         self.client_id = client_id
@@ -50,6 +74,17 @@ class Generator:
         self.client.access_token = response["access_token"]
         print("Access ok")
 
+    def _sync_batch(
+        self, run_activities, location_backfill, deduplicate_by_start_time=False
+    ):
+        created, updated, skipped = bulk_update_or_create_activities(
+            self.session, run_activities, deduplicate_by_start_time, location_backfill
+        )
+        sys.stdout.write("=" * skipped + "+" * created + "." * updated)
+        sys.stdout.flush()
+        self._known_run_ids.clear()
+        return created, updated
+
     def sync(self, force):
         self.check_access()
 
@@ -68,16 +103,18 @@ class Generator:
         for activity in self.client.get_activities(**filters):
             if self.only_run and activity.type != "Run":
                 continue
-            print(activity)    
+            print(activity)
             if IGNORE_BEFORE_SAVING:
                 activity.summary_polyline = filter_out(activity.summary_polyline)
             activity.source = "strava"
             created = update_or_create_activity(self.session, activity)
+            self._known_run_ids.clear()
             if created:
                 sys.stdout.write("+")
             else:
                 sys.stdout.write(".")
             sys.stdout.flush()
+        update_rollups(self.session)
         self.session.commit()
 
     def sync_from_data_dir(
@@ -89,13 +126,19 @@ class Generator:
         only_after_latest=False,
     ):
         loader = track_loader.TrackLoader()
-        tracks = loader.load_tracks(
-            data_dir, file_suffix=file_suffix, merge_tracks=merge_tracks
-        )
-        print(f"load {len(tracks)} tracks")
-        if not tracks:
-            print("No tracks found.")
-            return
+        if merge_tracks:
+            tracks = loader.load_tracks(data_dir, file_suffix=file_suffix)
+            print(f"load {len(tracks)} tracks")
+            if not tracks:
+                print("No tracks found.")
+                return
+        else:
+            # nothing to merge, so tracks are upserted while the rest is still parsed
+            tracks = (
+                t
+                for t in loader.iter_tracks(data_dir, file_suffix=file_suffix)
+                if t.length >= loader.min_length
+            )
 
         synced_files = []
         if file_suffix == "fit":
@@ -104,54 +147,58 @@ class Generator:
             func.max(Activity.start_date_local)
         ).scalar()
 
+        run_activities = []
+        created = updated = 0
+        location_backfill = LocationBackfill()
         for t in tracks:
             activity_id = t.file_names[0].split(".")[0]
             if file_suffix == "fit" and activity_id in name_mapping:
                 t.name = name_mapping[activity_id]
             run_activity = t.to_namedtuple()
+            synced_files.extend(t.file_names)
             if (
                 only_after_latest
                 and latest_start_time
                 and run_activity.start_date_local <= latest_start_time
             ):
                 sys.stdout.write("=")
-                synced_files.extend(t.file_names)
                 sys.stdout.flush()
                 continue
-            if deduplicate_by_start_time:
-                existing_activity = (
-                    self.session.query(Activity)
-                    .filter_by(start_date_local=run_activity.start_date_local)
-                    .first()
+            run_activities.append(run_activity)
+            if len(run_activities) >= SYNC_BATCH_SIZE:
+                batch_created, batch_updated = self._sync_batch(
+                    run_activities, location_backfill, deduplicate_by_start_time
                 )
-                if (
-                    existing_activity
-                    and existing_activity.run_id != int(run_activity.id)
-                ):
-                    sys.stdout.write("=")
-                    synced_files.extend(t.file_names)
-                    sys.stdout.flush()
-                    continue
-            created = update_or_create_activity(self.session, run_activity)
-            if created:
-                sys.stdout.write("+")
-            else:
-                sys.stdout.write(".")
-            synced_files.extend(t.file_names)
-            sys.stdout.flush()
+                created += batch_created
+                updated += batch_updated
+                run_activities = []
+        if run_activities:
+            batch_created, batch_updated = self._sync_batch(
+                run_activities, location_backfill, deduplicate_by_start_time
+            )
+            created += batch_created
+            updated += batch_updated
+        located = location_backfill.finish(self.session)
+        print(
+            f"\n{created} created, {updated} updated, {located} located, "
+            f"{geocode_cache.stats()}"
+        )
 
         save_synced_data_file_list(synced_files)
 
+        update_rollups(self.session)
         self.session.commit()
 
     def sync_from_kml_track(self, track):
         created = update_or_create_activity(self.session, track.to_namedtuple())
+        self._known_run_ids.clear()
         if created:
             sys.stdout.write("+")
         else:
             sys.stdout.write(".")
         sys.stdout.flush()
 
+        update_rollups(self.session)
         self.session.commit()
 
     def sync_from_app(self, app_tracks):
@@ -159,89 +206,108 @@ class Generator:
             print("No tracks found.")
             return
         print("Syncing tracks '+' means new track '.' means update tracks")
-        synced_files = []
-        for t in app_tracks:
-            created = update_or_create_activity(self.session, t)
-            if created:
-                sys.stdout.write("+")
-            else:
-                sys.stdout.write(".")
-            if "file_names" in t:
-                synced_files.extend(t.file_names)
-            sys.stdout.flush()
+        created = updated = 0
+        location_backfill = LocationBackfill()
+        for i in range(0, len(app_tracks), SYNC_BATCH_SIZE):
+            batch_created, batch_updated = self._sync_batch(
+                app_tracks[i : i + SYNC_BATCH_SIZE], location_backfill
+            )
+            created += batch_created
+            updated += batch_updated
+        located = location_backfill.finish(self.session)
+        print(
+            f"\n{created} created, {updated} updated, {located} located, "
+            f"{geocode_cache.stats()}"
+        )
 
+        update_rollups(self.session)
         self.session.commit()
 
-    def load(self):
-        activities = (
+    def scope(self, for_mapping=False):
+        """ROLLUP_SCOPES name of the activities of load() (or loadForMapping())."""
+        if for_mapping:
+            return "mapping"
+        return "runs" if self.only_run else "activities"
+
+    def query_activities(self, for_mapping=False):
+        """The activities load() (or loadForMapping()) returns, by start date."""
+        return (
             self.session.query(Activity)
-            .filter(Activity.distance > 0.1)
+            .filter(ROLLUP_SCOPES[self.scope(for_mapping)])
             .order_by(Activity.start_date_local)
         )
-        activity_list = []
 
-        streak = 0
-        last_date = None
-        for activity in activities:
-            if self.only_run and activity.type != "Run":
-                continue
-            # Determine running streak.
-            date = datetime.datetime.strptime(
-                activity.start_date_local, "%Y-%m-%d %H:%M:%S"
-            ).date()
-            if last_date is None:
-                streak = 1
-            elif date == last_date:
-                pass
-            elif date == last_date + datetime.timedelta(days=1):
-                streak += 1
-            else:
-                assert date > last_date
-                streak = 1
-            activity.streak = streak
-            last_date = date
-            if not IGNORE_BEFORE_SAVING:
-                activity.summary_polyline = filter_out(activity.summary_polyline)
-            activity_list.append(activity.to_dict())
+    def filters_polylines(self, for_mapping=False):
+        return not for_mapping and not IGNORE_BEFORE_SAVING
 
-        return activity_list
+    def polyline_filter(self, for_mapping=False):
+        """settings_digest() of the polylines of load(), False when unfiltered."""
+        return self.filters_polylines(for_mapping) and settings_digest()
+
+    def activity_dict(self, activity, for_mapping=False, level=0):
+        """activity.to_dict() as load() has it, without streak or changing activity.
+
+        With level, summary_polyline is the one of that polyline level.
+        """
+        activity_dict = activity.to_dict()
+        if level:
+            activity_dict["summary_polyline"] = activity.summary_polyline_at(level)
+        if self.filters_polylines(for_mapping):
+            activity_dict["summary_polyline"] = filter_out_cache.filter_out(
+                self.session, activity_dict["summary_polyline"]
+            )
+        return activity_dict
+
+    def write_activities_file(self, json_file, for_mapping=False, indent=0, level=0):
+        """json.dump load() (or loadForMapping()) to json_file, only what changed.
+
+        level picks a coarser polyline of generator.polyline_levels.
+        """
+        return write_activities_file(self, json_file, for_mapping, indent, level)
+
+    def load(self):
+        return self._load()
 
     def loadForMapping(self):
-        activities = (
-            self.session.query(Activity)
-            .filter(Activity.type.in_(MAPPING_TYPE))
-            .order_by(Activity.start_date_local)
-        )
+        return self._load(for_mapping=True)
+
+    def _load(self, for_mapping=False):
+        # streaks are read from the rollups, bring them up to date first, the
+        # caller commits them or not
+        update_rollups(self.session)
+        activities = with_streaks(
+            self.query_activities(for_mapping), self.scope(for_mapping)
+        ).options(selectinload(Activity.polyline))
         activity_list = []
-
-        streak = 0
-        last_date = None
-        for activity in activities:
-            # Determine running streak.
-            # if activity.type == "Run" or activity.type == "Walk":
-            date = datetime.datetime.strptime(
-                activity.start_date_local, "%Y-%m-%d %H:%M:%S"
-            ).date()
-            if last_date is None:
-                streak = 1
-            elif date == last_date:
-                pass
-            elif date == last_date + datetime.timedelta(days=1):
-                streak += 1
-            else:
-                assert date > last_date
-                streak = 1
-            activity.streak = streak
-            last_date = date
-            activity_list.append(activity.to_dict())
+        for activity, streak in activities:
+            activity_dict = self.activity_dict(activity, for_mapping)
+            activity_dict["streak"] = streak
+            activity_list.append(activity_dict)
 
         return activity_list
 
+    def known_run_ids(self, source=None):
+        """Set of the saved run_ids, of one source only when given.
+
+        Read with one single column query and kept until activities are synced.
+        """
+        if source not in self._known_run_ids:
+            query = self.session.query(Activity.run_id)
+            if source is not None:
+                query = query.filter(Activity.source == source)
+            self._known_run_ids[source] = {run_id for (run_id,) in query}
+        return self._known_run_ids[source]
+
+    def contains_many(self, run_ids, source=None):
+        """Whether each of run_ids (ints or digit strings) is saved, in order."""
+        known_run_ids = self.known_run_ids(source)
+        return [_as_run_id(run_id) in known_run_ids for run_id in run_ids]
+
     def get_old_tracks_ids(self):
+        """Set of the saved run_ids as strings."""
         try:
-            activities = self.session.query(Activity).all()
-            return [str(a.run_id) for a in activities]
+            return {str(run_id) for run_id in self.known_run_ids()}
         except Exception as e:
             # pass the error
             print(f"something wrong with {str(e)}")
-            return []
+            return set()
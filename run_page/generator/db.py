@@ -1,14 +1,44 @@
+import atexit
 import datetime
+import hashlib
+import os
 import random
 import string
 import time
+import zlib
 
 import geopy
-from config import TYPE_DICT
+import s2sphere as s2
+from config import GEOCODE_CELL_LEVEL, GEOCODE_ONLINE, TYPE_DICT
 from geopy.geocoders import Nominatim
-from sqlalchemy import Column, Float, Integer, Interval, String, create_engine
+from sqlalchemy import (
+    Column,
+    Computed,
+    Float,
+    Index,
+    Integer,
+    Interval,
+    LargeBinary,
+    String,
+    create_engine,
+    event,
+    exists,
+    func,
+    inspect,
+)
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import (
+    attribute_keyed_dict,
+    close_all_sessions,
+    relationship,
+    sessionmaker,
+)
+
+from polyline_codec import first_point
+from polyline_processor import filter_out, settings_digest
+
+from .geocoder import OfflineGeocoder
 
 Base = declarative_base()
 
@@ -42,8 +72,64 @@ ACTIVITY_KEYS = [
 ]
 
 
+def compress_polyline(summary_polyline):
+    """zlib compressed polyline, an empty one stays empty."""
+    if not summary_polyline:
+        return b""
+    return zlib.compress(summary_polyline.encode("utf-8"))
+
+
+def decompress_polyline(data):
+    if not data:
+        return ""
+    return zlib.decompress(data).decode("utf-8")
+
+
+def _polyline_digest(summary_polyline):
+    return hashlib.sha1(summary_polyline.encode("utf-8")).hexdigest()
+
+
+def polyline_columns(summary_polyline):
+    """polyline and digest of the activity_polylines row of summary_polyline."""
+    return {
+        "polyline": compress_polyline(summary_polyline),
+        "digest": _polyline_digest(summary_polyline),
+    }
+
+
+class ActivityPolyline(Base):
+    """Compressed polyline of an activity, apart so activity rows stay small.
+
+    Level 0 is summary_polyline as it was saved, higher levels are simplified
+    copies of it (see generator.polyline_levels). An empty summary_polyline is
+    saved as an empty row, so it is read back as "" and not as None. Only an
+    activity whose summary_polyline is NULL has no row.
+    """
+
+    __tablename__ = "activity_polylines"
+    __table_args__ = (Index("ix_activity_polylines_digest", "digest"),)
+
+    run_id = Column(Integer, primary_key=True)
+    level = Column(Integer, primary_key=True, default=0)
+    polyline = Column(LargeBinary)
+    # sha1 of the polyline before compression, the key of its filtered_polylines
+    digest = Column(String)
+
+
+# moving_time in seconds, generated by SQLite so it is always in sync, the
+# rollups sum it up. start_date and start_date_local need no epoch copies: both
+# start with "YYYY-MM-DD HH:MM:SS" (start_date may go on with "+00:00"), so
+# string order is time order and range and max() queries use their indexes.
+MOVING_SECONDS = "CAST(strftime('%s', moving_time) AS INTEGER)"
+
+
 class Activity(Base):
     __tablename__ = "activities"
+    __table_args__ = (
+        Index("ix_activities_start_date_local", "start_date_local"),
+        Index("ix_activities_type_start_date_local", "type", "start_date_local"),
+        Index("ix_activities_start_date", "start_date"),
+    )
 
     run_id = Column(Integer, primary_key=True)
     name = Column(String)
@@ -54,13 +140,53 @@ class Activity(Base):
     start_date = Column(String)
     start_date_local = Column(String)
     location_country = Column(String)
-    summary_polyline = Column(String)
     average_heartrate = Column(Float)
     average_speed = Column(Float)
     streak = None
     source = Column(String)
     relive_url = Column(String)
     video_url = Column(String)
+    # loaded on first access of summary_polyline only
+    polyline = relationship(
+        ActivityPolyline,
+        primaryjoin="and_(Activity.run_id == foreign(ActivityPolyline.run_id), "
+        "ActivityPolyline.level == 0)",
+        uselist=False,
+        cascade="all, delete-orphan",
+    )
+    # simplified polylines by level, written by generator.polyline_levels only
+    levels = relationship(
+        ActivityPolyline,
+        primaryjoin="and_(Activity.run_id == foreign(ActivityPolyline.run_id), "
+        "ActivityPolyline.level > 0)",
+        collection_class=attribute_keyed_dict("level"),
+        viewonly=True,
+    )
+    moving_seconds = Column(Integer, Computed(MOVING_SECONDS))
+
+    @property
+    def summary_polyline(self):
+        if self.polyline is None:
+            return None
+        return decompress_polyline(self.polyline.polyline)
+
+    @summary_polyline.setter
+    def summary_polyline(self, summary_polyline):
+        if summary_polyline is None:
+            self.polyline = None
+            return
+        columns = polyline_columns(summary_polyline)
+        if self.polyline is None:
+            self.polyline = ActivityPolyline(level=0, **columns)
+        elif self.polyline.polyline != columns["polyline"]:
+            self.polyline.polyline = columns["polyline"]
+            self.polyline.digest = columns["digest"]
+
+    def summary_polyline_at(self, level):
+        """summary_polyline simplified to level, as saved when level is not built."""
+        if level and level in self.levels:
+            return decompress_polyline(self.levels[level].polyline)
+        return self.summary_polyline
 
     def to_dict(self):
         out = {}
@@ -77,70 +203,423 @@ class Activity(Base):
         return out
 
 
+# columns refreshed when an already saved activity is synced again
+UPDATE_KEYS = [
+    "name",
+    "distance",
+    "moving_time",
+    "elapsed_time",
+    "type",
+    "average_heartrate",
+    "average_speed",
+    "summary_polyline",
+    "source",
+]
+
+# stay below the SQLite limit of variables in one statement
+IN_QUERY_CHUNK_SIZE = 500
+# seconds an export_state row is kept without being built again
+EXPORT_STATE_MAX_AGE = 30 * 24 * 60 * 60
+
+
+def _chunks(values, size=IN_QUERY_CHUNK_SIZE):
+    for i in range(0, len(values), size):
+        yield values[i : i + size]
+
+
+def _activity_row(run_activity):
+    """Column values of an activity, location_country is looked up on insert only."""
+    type = run_activity.type
+    source = run_activity.source if hasattr(run_activity, "source") else "gpx"
+    if run_activity.type in TYPE_DICT:
+        type = TYPE_DICT[run_activity.type]
+    return {
+        "run_id": int(run_activity.id),
+        "name": run_activity.name,
+        "distance": float(run_activity.distance),
+        "moving_time": run_activity.moving_time,
+        "elapsed_time": run_activity.elapsed_time,
+        "type": type,
+        "start_date": run_activity.start_date,
+        "start_date_local": run_activity.start_date_local,
+        "average_heartrate": run_activity.average_heartrate,
+        "average_speed": float(run_activity.average_speed),
+        "summary_polyline": (
+            run_activity.map and run_activity.map.summary_polyline or ""
+        ),
+        "source": source,
+    }
+
+
+class ActivityChange(Base):
+    """run_id of every inserted, changed or deleted activity, written by triggers."""
+
+    __tablename__ = "activity_changes"
+    # seq must not be reused after the log is pruned
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    seq = Column(Integer, primary_key=True)
+    run_id = Column(Integer)
+
+
+class ExportState(Base):
+    """What an activities file (or the rollups) was last built from.
+
+    See generator.export and generator.rollup.
+    """
+
+    __tablename__ = "export_state"
+
+    name = Column(String, primary_key=True)
+    options = Column(String)
+    change_seq = Column(Integer)
+    sha1 = Column(String)
+    # time.time() of the last build, see prune_activity_changes
+    updated = Column(Integer)
+
+
+class RollupDay(Base):
+    """Totals and running streak of the activities of one local day."""
+
+    __tablename__ = "rollup_days"
+
+    scope = Column(String, primary_key=True)
+    day = Column(String, primary_key=True)
+    count = Column(Integer)
+    distance = Column(Float)
+    moving_time = Column(Integer)
+    streak = Column(Integer)
+
+
+class RollupActivity(Base):
+    """The day every activity was counted in, to take it out again."""
+
+    __tablename__ = "rollup_activities"
+
+    run_id = Column(Integer, primary_key=True)
+    day = Column(String)
+
+
+def _change_log_triggers():
+    changed = " OR ".join(
+        f"OLD.{c.name} IS NOT NEW.{c.name}" for c in Activity.__table__.columns
+    )
+    return [
+        """CREATE TRIGGER IF NOT EXISTS activities_insert_log AFTER INSERT ON activities
+        BEGIN
+            INSERT INTO activity_changes (run_id) VALUES (NEW.run_id);
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS activities_update_log AFTER UPDATE ON activities
+        WHEN {changed}
+        BEGIN
+            INSERT INTO activity_changes (run_id) VALUES (OLD.run_id);
+            INSERT INTO activity_changes (run_id)
+                SELECT NEW.run_id WHERE NEW.run_id IS NOT OLD.run_id;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS activities_delete_log AFTER DELETE ON activities
+        BEGIN
+            INSERT INTO activity_changes (run_id) VALUES (OLD.run_id);
+            DELETE FROM activity_polylines WHERE run_id = OLD.run_id;
+        END""",
+        # the simplified levels follow level 0, their changes are not logged
+        """CREATE TRIGGER IF NOT EXISTS activity_polylines_insert_log
+        AFTER INSERT ON activity_polylines
+        WHEN NEW.level = 0
+        BEGIN
+            INSERT INTO activity_changes (run_id) VALUES (NEW.run_id);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS activity_polylines_update_log
+        AFTER UPDATE ON activity_polylines
+        WHEN (OLD.level = 0 OR NEW.level = 0)
+            AND (OLD.polyline IS NOT NEW.polyline OR OLD.run_id IS NOT NEW.run_id)
+        BEGIN
+            INSERT INTO activity_changes (run_id) VALUES (OLD.run_id);
+            INSERT INTO activity_changes (run_id)
+                SELECT NEW.run_id WHERE NEW.run_id IS NOT OLD.run_id;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS activity_polylines_delete_log
+        AFTER DELETE ON activity_polylines
+        WHEN OLD.level = 0
+        BEGIN
+            INSERT INTO activity_changes (run_id) VALUES (OLD.run_id);
+        END""",
+    ]
+
+
+def save_export_state(session, name, options, change_seq, sha1=None):
+    """Record what name was built from and drop the changes no one needs any more."""
+    session.merge(
+        ExportState(
+            name=name,
+            options=options,
+            change_seq=change_seq,
+            sha1=sha1,
+            updated=int(time.time()),
+        )
+    )
+    prune_activity_changes(session)
+
+
+def prune_activity_changes(session):
+    """Drop the changes every export_state row has seen already.
+
+    A row not built again for EXPORT_STATE_MAX_AGE (a file exported once to
+    another path, posters no longer drawn from levels) is dropped first, so it
+    does not hold the change log back forever; it is built in full if it ever
+    comes back.
+    """
+    session.query(ExportState).filter(
+        ExportState.updated < int(time.time()) - EXPORT_STATE_MAX_AGE
+    ).delete()
+    oldest_seq = session.query(func.min(ExportState.change_seq)).scalar()
+    if oldest_seq is not None:
+        session.query(ActivityChange).filter(ActivityChange.seq <= oldest_seq).delete()
+
+
+class FilteredPolyline(Base):
+    """filter_out() of a polyline, compressed, by sha1 of the polyline and settings.
+
+    A polyline filtered out completely is NULL.
+    """
+
+    __tablename__ = "filtered_polylines"
+
+    digest = Column(String, primary_key=True)
+    settings = Column(String, primary_key=True)
+    polyline = Column(LargeBinary)
+
+
+class FilterOutCache:
+    """filter_out() memoized in the database.
+
+    Only results of the current privacy settings are used, so changing
+    IGNORE_POLYLINE, IGNORE_RANGE or IGNORE_START_END_RANGE filters every
+    polyline again. save() writes the new results and drops the ones of other
+    settings and of polylines no longer saved, the caller commits.
+    """
+
+    def __init__(self):
+        self.settings = settings_digest()
+        self.bind = None
+        self.results = None
+        self.new_results = {}
+
+    def _results(self, session):
+        # the results of one database only, load them again for another one
+        if self.results is None or self.bind is not session.get_bind():
+            self.bind = session.get_bind()
+            self.new_results = {}
+            self.results = {
+                digest: None if data is None else decompress_polyline(data)
+                for digest, data in session.query(
+                    FilteredPolyline.digest, FilteredPolyline.polyline
+                ).filter(FilteredPolyline.settings == self.settings)
+            }
+        return self.results
+
+    def filter_out(self, session, summary_polyline):
+        if not summary_polyline:
+            return filter_out(summary_polyline)
+        digest = _polyline_digest(summary_polyline)
+        results = self._results(session)
+        if digest not in results:
+            results[digest] = self.new_results[digest] = filter_out(summary_polyline)
+        return results[digest]
+
+    def save(self, session):
+        """Returns whether the cache changed, so there is something to commit."""
+        if self.results is None or self.bind is not session.get_bind():
+            return False
+        changed = bool(
+            session.query(FilteredPolyline)
+            .filter(FilteredPolyline.settings != self.settings)
+            .delete()
+        )
+        if self.new_results:
+            session.bulk_insert_mappings(
+                FilteredPolyline,
+                [
+                    {
+                        "digest": digest,
+                        "settings": self.settings,
+                        "polyline": None if p is None else compress_polyline(p),
+                    }
+                    for digest, p in self.new_results.items()
+                ],
+            )
+            self.new_results = {}
+            changed = True
+        # polylines of every level are filtered, see Generator.activity_dict()
+        stale = (
+            session.query(FilteredPolyline)
+            .filter(~exists().where(ActivityPolyline.digest == FilteredPolyline.digest))
+            .delete(synchronize_session=False)
+        )
+        if stale:
+            # loaded again without them when they are needed
+            self.results = None
+            changed = True
+        return changed
+
+
+filter_out_cache = FilterOutCache()
+
+
+class Geocode(Base):
+    """Reverse geocoding result of every S2 cell an activity started in."""
+
+    __tablename__ = "geocode_cache"
+
+    cell_id = Column(String, primary_key=True)
+    location_country = Column(String)
+
+
+class GeocodeCache:
+    """Reverse geocode start points, without network access unless online is set.
+
+    A point in an S2 cell geocoded online before reuses that result. Other
+    points are resolved by the OfflineGeocoder, which knows the locations of
+    the saved activities. With online, Nominatim is asked once per cell for
+    the points the offline geocoder has no city for.
+    """
+
+    def __init__(self, level=GEOCODE_CELL_LEVEL, online=GEOCODE_ONLINE):
+        self.level = level
+        self.online = online
+        self.locations = {}
+        self.offline_geocoder = None
+        self.hits = 0
+        self.offline = 0
+        self.misses = 0
+
+    def cell_id(self, lat, lon):
+        return (
+            s2.CellId.from_lat_lng(s2.LatLng.from_degrees(lat, lon))
+            .parent(self.level)
+            .to_token()
+        )
+
+    def _offline_geocoder(self, session):
+        if self.offline_geocoder is None:
+            geocoder = OfflineGeocoder()
+            for cell_id, location_country in session.query(
+                Geocode.cell_id, Geocode.location_country
+            ):
+                point = s2.CellId.from_token(cell_id).to_lat_lng()
+                geocoder.add_location(
+                    point.lat().degrees, point.lng().degrees, location_country
+                )
+            for polyline, location_country in (
+                session.query(ActivityPolyline.polyline, Activity.location_country)
+                .join(Activity.polyline)
+                .filter(Activity.location_country != "")
+            ):
+                point = first_point(decompress_polyline(polyline))
+                if point:
+                    geocoder.add_location(*point, location_country)
+            self.offline_geocoder = geocoder
+        return self.offline_geocoder
+
+    def resolve(self, session, lat, lon):
+        """(location, cell_id) from the cache or a known location nearby.
+
+        location is None when neither knows the point.
+        """
+        cell_id = self.cell_id(lat, lon)
+        location_country = self.locations.get(cell_id)
+        if location_country is None:
+            geocode = session.get(Geocode, cell_id)
+            if geocode is not None:
+                location_country = self.locations[cell_id] = geocode.location_country
+        if location_country is not None:
+            self.hits += 1
+            return location_country, cell_id
+        location_country = self._offline_geocoder(session).nearby(lat, lon)
+        if location_country is not None:
+            self.offline += 1
+        return location_country, cell_id
+
+    def region(self, session, lat, lon):
+        location_country = self._offline_geocoder(session).region(lat, lon)
+        if location_country is not None:
+            self.offline += 1
+        return location_country
+
+    def reverse_online(self, lat, lon, throttle=None):
+        """Ask Nominatim, None when it fails.
+
+        No session is used, so this can run in another thread. throttle is
+        called before every request.
+        """
+        self.misses += 1
+        for _ in range(2):
+            # limit (only for the first time), so try again once
+            if throttle:
+                throttle()
+            try:
+                return str(g.reverse(f"{lat}, {lon}", language="zh-CN"))
+            except Exception as e:
+                pass
+        return None
+
+    def store(self, session, cell_id, lat, lon, location_country):
+        """Save the online result of a cell."""
+        self.locations[cell_id] = location_country
+        session.merge(Geocode(cell_id=cell_id, location_country=location_country))
+        self._offline_geocoder(session).add_location(lat, lon, location_country)
+
+    def reverse(self, session, lat, lon):
+        location_country, cell_id = self.resolve(session, lat, lon)
+        if location_country is None and self.online:
+            location_country = self.reverse_online(lat, lon)
+            if location_country is not None:
+                self.store(session, cell_id, lat, lon, location_country)
+        return location_country or self.region(session, lat, lon)
+
+    def stats(self):
+        return (
+            f"geocoding: {self.hits} cached, {self.offline} offline, "
+            f"{self.misses} online"
+        )
+
+
+geocode_cache = GeocodeCache()
+
+
+def needs_location(run_activity):
+    start_point = run_activity.start_latlng
+    location_country = getattr(run_activity, "location_country", "")
+    # or China for #176 to fix
+    return not location_country and start_point or location_country == "China"
+
+
+def _location_country(session, run_activity):
+    location_country = getattr(run_activity, "location_country", "")
+    if needs_location(run_activity):
+        start_point = run_activity.start_latlng
+        location_country = (
+            geocode_cache.reverse(session, start_point.lat, start_point.lon)
+            or location_country
+        )
+    return location_country
+
+
 def update_or_create_activity(session, run_activity):
     created = False
     try:
         activity = (
             session.query(Activity).filter_by(run_id=int(run_activity.id)).first()
         )
-        type = run_activity.type
-        source = run_activity.source if hasattr(run_activity, "source") else "gpx"
-        if run_activity.type in TYPE_DICT:
-            type = TYPE_DICT[run_activity.type]
+        row = _activity_row(run_activity)
         if not activity:
-            start_point = run_activity.start_latlng
-            location_country = getattr(run_activity, "location_country", "")
-            # or China for #176 to fix
-            if not location_country and start_point or location_country == "China":
-                try:
-                    location_country = str(
-                        g.reverse(
-                            f"{start_point.lat}, {start_point.lon}", language="zh-CN"
-                        )
-                    )
-                # limit (only for the first time)
-                except Exception as e:
-                    try:
-                        location_country = str(
-                            g.reverse(
-                                f"{start_point.lat}, {start_point.lon}",
-                                language="zh-CN",
-                            )
-                        )
-                    except Exception as e:
-                        pass
-
             activity = Activity(
-                run_id=run_activity.id,
-                name=run_activity.name,
-                distance=run_activity.distance,
-                moving_time=run_activity.moving_time,
-                elapsed_time=run_activity.elapsed_time,
-                type=type,
-                start_date=run_activity.start_date,
-                start_date_local=run_activity.start_date_local,
-                location_country=location_country,
-                average_heartrate=run_activity.average_heartrate,
-                average_speed=float(run_activity.average_speed),
-                summary_polyline=(
-                    run_activity.map and run_activity.map.summary_polyline or ""
-                ),
-                source=source,
+                location_country=_location_country(session, run_activity), **row
             )
             session.add(activity)
             created = True
         else:
-            activity.name = run_activity.name
-            activity.distance = float(run_activity.distance)
-            activity.moving_time = run_activity.moving_time
-            activity.elapsed_time = run_activity.elapsed_time
-            activity.type = type
-            activity.average_heartrate = run_activity.average_heartrate
-            activity.average_speed = float(run_activity.average_speed)
-            activity.summary_polyline = (
-                run_activity.map and run_activity.map.summary_polyline or ""
-            )
-            activity.source = source
+            for key in UPDATE_KEYS:
+                setattr(activity, key, row[key])
     except Exception as e:
         print(f"something wrong with {run_activity.id}")
         print(str(e))
@@ -148,10 +627,230 @@ def update_or_create_activity(session, run_activity):
     return created
 
 
-def init_db(db_path):
-    engine = create_engine(
-        f"sqlite:///{db_path}", connect_args={"check_same_thread": False}
+def _upsert_polyline():
+    statement = insert(ActivityPolyline)
+    return statement.on_conflict_do_update(
+        index_elements=["run_id", "level"],
+        set_={
+            "polyline": statement.excluded.polyline,
+            "digest": statement.excluded.digest,
+        },
+        # unchanged polylines are not written, so they are not logged as changes
+        where=ActivityPolyline.polyline.is_distinct_from(statement.excluded.polyline),
     )
-    Base.metadata.create_all(engine)
-    session = sessionmaker(bind=engine)
+
+
+def bulk_update_or_create_activities(
+    session, run_activities, deduplicate_by_start_time=False, location_backfill=None
+):
+    """Upsert a batch of activities, the same as update_or_create_activity for each.
+
+    Existing rows are found with one IN query per chunk of run ids, the new and
+    changed rows are written with executemany in the session's transaction.
+    With deduplicate_by_start_time an activity is skipped when another run id
+    already has the same start_date_local. With a location_backfill, new
+    rows are inserted with the location they come with and handed to it,
+    instead of waiting for their geocoding here.
+
+    Returns:
+        (created, updated, skipped) counts.
+    """
+    rows = {}
+    for run_activity in run_activities:
+        try:
+            row = _activity_row(run_activity)
+        except Exception as e:
+            print(f"something wrong with {run_activity.id}")
+            print(str(e))
+            continue
+        rows[row["run_id"]] = (run_activity, row)
+
+    run_ids = list(rows)
+    existing_ids = set()
+    for chunk in _chunks(run_ids):
+        existing_ids.update(
+            run_id
+            for (run_id,) in session.query(Activity.run_id).filter(
+                Activity.run_id.in_(chunk)
+            )
+        )
+    start_run_ids = {}
+    if deduplicate_by_start_time:
+        start_dates = list({row["start_date_local"] for _, row in rows.values()})
+        for chunk in _chunks(start_dates):
+            for start_date_local, run_id in session.query(
+                Activity.start_date_local, Activity.run_id
+            ).filter(Activity.start_date_local.in_(chunk)):
+                start_run_ids.setdefault(start_date_local, run_id)
+
+    new_rows, changed_rows, polyline_rows = [], [], []
+    skipped = 0
+    for run_id, (run_activity, row) in rows.items():
+        if deduplicate_by_start_time:
+            other_id = start_run_ids.setdefault(row["start_date_local"], run_id)
+            if other_id != run_id:
+                skipped += 1
+                continue
+        if run_id not in existing_ids:
+            try:
+                if location_backfill is None:
+                    row["location_country"] = _location_country(session, run_activity)
+                else:
+                    location_country = getattr(run_activity, "location_country", "")
+                    row["location_country"] = location_country
+                    if needs_location(run_activity):
+                        start_point = run_activity.start_latlng
+                        location_backfill.submit(
+                            session,
+                            run_id,
+                            start_point.lat,
+                            start_point.lon,
+                            location_country,
+                        )
+            except Exception as e:
+                print(f"something wrong with {run_id}")
+                print(str(e))
+                continue
+        polyline_rows.append(
+            {
+                "run_id": run_id,
+                "level": 0,
+                **polyline_columns(row.pop("summary_polyline")),
+            }
+        )
+        if run_id in existing_ids:
+            changed_rows.append(
+                {key: row[key] for key in ["run_id"] + UPDATE_KEYS if key in row}
+            )
+        else:
+            new_rows.append(row)
+
+    if new_rows:
+        session.bulk_insert_mappings(Activity, new_rows)
+    if changed_rows:
+        session.bulk_update_mappings(Activity, changed_rows)
+    if polyline_rows:
+        session.execute(_upsert_polyline(), polyline_rows)
+    return len(new_rows), len(changed_rows), skipped
+
+
+def _move_polylines(conn):
+    rows = conn.exec_driver_sql(
+        "SELECT run_id, summary_polyline FROM activities "
+        "WHERE summary_polyline IS NOT NULL"
+    ).fetchall()
+    if rows:
+        conn.execute(
+            insert(ActivityPolyline),
+            [
+                {"run_id": run_id, "level": 0, **polyline_columns(summary_polyline)}
+                for run_id, summary_polyline in rows
+            ],
+        )
+    # the trigger names every column, init_db() creates it again without
+    conn.exec_driver_sql("DROP TRIGGER IF EXISTS activities_update_log")
+    conn.exec_driver_sql("ALTER TABLE activities DROP COLUMN summary_polyline")
+
+
+# schema changes of tables that already exist, create_all() makes new tables.
+# MIGRATIONS[i] brings a database from PRAGMA user_version i to i + 1, it is a
+# list of statements or a function of the connection.
+MIGRATIONS = [
+    [
+        "CREATE INDEX IF NOT EXISTS ix_activities_start_date_local "
+        "ON activities (start_date_local)",
+        "CREATE INDEX IF NOT EXISTS ix_activities_type_start_date_local "
+        "ON activities (type, start_date_local)",
+        "CREATE INDEX IF NOT EXISTS ix_activities_start_date "
+        "ON activities (start_date)",
+    ],
+    [
+        "ALTER TABLE activities ADD COLUMN moving_seconds INTEGER "
+        f"GENERATED ALWAYS AS ({MOVING_SECONDS}) VIRTUAL"
+    ],
+    _move_polylines,
+]
+
+
+def migrate(engine, created=False):
+    """Run the MIGRATIONS the database has not seen, none when it was just created."""
+    with engine.begin() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        if not created:
+            for migration in MIGRATIONS[version:]:
+                if callable(migration):
+                    migration(conn)
+                    continue
+                for statement in migration:
+                    conn.exec_driver_sql(statement)
+        if version != len(MIGRATIONS):
+            conn.exec_driver_sql(f"PRAGMA user_version = {len(MIGRATIONS)}")
+    if not created and version < len(MIGRATIONS):
+        # give back the space of dropped columns, data.db is committed
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql("VACUUM")
+
+
+# set on every connection, WAL lets readers and the writer work at the same time
+SQLITE_PRAGMAS = [
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "mmap_size=268435456",  # 256 MiB
+    "cache_size=-32768",  # 32 MiB
+    "busy_timeout=5000",  # ms
+]
+
+# engines by absolute database path, shared by all init_db() calls of a process
+_engines = {}
+
+
+def _tune_connection(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
+
+@atexit.register
+def close_engines():
+    """Move the WAL into the database files and close them.
+
+    data.db is committed, so it must hold everything and stay in rollback
+    journal mode once the process is done with it.
+    """
+    # sessions left open would keep their connections
+    close_all_sessions()
+    for db_path, engine in list(_engines.items()):
+        engine.dispose()
+        try:
+            with engine.connect() as conn:
+                conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+                conn.exec_driver_sql("PRAGMA journal_mode=DELETE")
+        except Exception as e:
+            print(f"can not checkpoint {db_path}: {str(e)}")
+        engine.dispose()
+        del _engines[db_path]
+
+
+def get_engine(db_path):
+    """The engine of db_path, created, migrated and tuned on first use."""
+    db_path = os.path.abspath(db_path)
+    engine = _engines.get(db_path)
+    if engine is None:
+        engine = create_engine(
+            f"sqlite:///{db_path}", connect_args={"check_same_thread": False}
+        )
+        event.listen(engine, "connect", _tune_connection)
+        created = not inspect(engine).has_table(Activity.__tablename__)
+        Base.metadata.create_all(engine)
+        migrate(engine, created)
+        with engine.begin() as conn:
+            for trigger in _change_log_triggers():
+                conn.exec_driver_sql(trigger)
+        _engines[db_path] = engine
+    return engine
+
+
+def init_db(db_path):
+    session = sessionmaker(bind=get_engine(db_path))
     return session()
@@ -0,0 +1,142 @@
+"""
+Write the activities file again, serializing only the activities that changed.
+"""
+
+import hashlib
+import json
+import os
+import re
+
+from config import POLYLINE_LEVELS
+from sqlalchemy import func
+from sqlalchemy.orm import selectinload
+
+from .db import (
+    Activity,
+    ActivityChange,
+    ActivityPolyline,
+    ExportState,
+    _chunks,
+    filter_out_cache,
+    save_export_state,
+)
+from .polyline_levels import update_polyline_levels
+from .rollup import update_rollups, with_streaks
+
+_SEPARATOR = re.compile(r"\s*,?\s*")
+
+
+def _read_records(text):
+    """(text, dict) of every activity of an exported file, keyed by run_id."""
+    records = {}
+    decoder = json.JSONDecoder()
+    pos = _SEPARATOR.match(text, text.index("[") + 1).end()
+    while text[pos] != "]":
+        record, end = decoder.raw_decode(text, pos)
+        records[record["run_id"]] = (text[pos:end], record)
+        pos = _SEPARATOR.match(text, end).end()
+    return records
+
+
+def write_activities_file(generator, json_file, for_mapping=False, indent=0, level=0):
+    """Write the same file as json.dump of generator.load()/loadForMapping().
+
+    With level, the polylines are the ones simplified to POLYLINE_LEVELS[level - 1]
+    meters, so the file is smaller for maps that do not need every point.
+
+    Streaks come from the rollups. An activity is serialized again only when
+    the change log has it since the last export or its streak changed, all
+    others are copied from the file as it was written last time. The whole
+    file is written when it is not the one exported last or the options differ.
+
+    Returns:
+        The number of serialized activities.
+    """
+    session = generator.session
+    update_rollups(session)
+    if level:
+        # only built for the files and posters that use them
+        update_polyline_levels(session)
+    # two files of the same name in different places are different exports
+    name = os.path.realpath(json_file)
+    options = json.dumps(
+        {
+            "for_mapping": for_mapping,
+            "indent": indent,
+            "only_run": bool(generator.only_run) and not for_mapping,
+            "filter_out": generator.polyline_filter(for_mapping),
+            "level": level and POLYLINE_LEVELS[level - 1],
+        },
+        sort_keys=True,
+    )
+    change_seq = session.query(func.max(ActivityChange.seq)).scalar() or 0
+
+    records = {}
+    changed = None
+    state = session.get(ExportState, name)
+    if state is not None and state.options == options and os.path.exists(json_file):
+        with open(json_file, "rb") as f:
+            data = f.read()
+        if hashlib.sha1(data).hexdigest() == state.sha1:
+            changed = {
+                run_id
+                for (run_id,) in session.query(ActivityChange.run_id).filter(
+                    ActivityChange.seq > state.change_seq
+                )
+            }
+            if not changed:
+                return 0
+            records = _read_records(data.decode("utf-8"))
+
+    rows = with_streaks(
+        generator.query_activities(for_mapping).with_entities(Activity.run_id),
+        generator.scope(for_mapping),
+    ).all()
+
+    stale = [
+        run_id
+        for run_id, _ in rows
+        if run_id not in records or (changed is not None and run_id in changed)
+    ]
+    activities = session.query(Activity).options(selectinload(Activity.polyline))
+    if level:
+        activities = activities.options(
+            selectinload(Activity.levels.and_(ActivityPolyline.level == level))
+        )
+    activity_dicts = {}
+    for chunk in _chunks(stale):
+        for activity in activities.filter(Activity.run_id.in_(chunk)):
+            activity_dicts[activity.run_id] = generator.activity_dict(
+                activity, for_mapping, level
+            )
+
+    texts = []
+    serialized = 0
+    for run_id, streak in rows:
+        if run_id in activity_dicts:
+            activity_dict = activity_dicts[run_id]
+        else:
+            text, activity_dict = records[run_id]
+            if activity_dict.get("streak") == streak:
+                texts.append(text)
+                continue
+        activity_dict["streak"] = streak
+        texts.append(json.dumps(activity_dict, indent=indent))
+        serialized += 1
+
+    if not texts:
+        output = "[]"
+    elif indent is None:
+        output = "[" + ", ".join(texts) + "]"
+    else:
+        output = "[\n" + ",\n".join(texts) + "\n]"
+    data = output.encode("utf-8")
+    with open(json_file, "wb") as f:
+        f.write(data)
+
+    save_export_state(
+        session, name, options, change_seq, sha1=hashlib.sha1(data).hexdigest()
+    )
+    filter_out_cache.save(session)
+    session.commit()
+    return serialized
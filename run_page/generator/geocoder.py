@@ -0,0 +1,145 @@
+"""
+Offline reverse geocoding from the city names and province outlines of the front end.
+"""
+
+import json
+import math
+import re
+
+import numpy as np
+from config import CITY_FILE, RUN_COUNTRIES_FILE
+
+CHINA = "中国"
+# a known location is reused for points up to this far away
+KNOWN_LOCATION_RADIUS = 3000  # m
+# side of the grid cells known locations are indexed in
+GRID_DEGREES = 0.05
+EARTH_RADIUS = 6371008.8  # m
+
+
+def load_ts_literal(file_name):
+    """The object or array literal exported by a .ts data file, parsed as JSON."""
+    with open(file_name, encoding="utf-8") as f:
+        text = f.read()
+    literal = re.search(r"=\s*([\[{].*[\]}])\s*;?\s*$", text, re.S).group(1)
+    literal = re.sub(r"^\s*//.*$", "", literal, flags=re.M)
+    # 'text' -> "text"
+    literal = re.sub(r"'((?:[^'\\]|\\.)*)'", lambda m: json.dumps(m.group(1)), literal)
+    # key: -> "key":
+    literal = re.sub(r"([{,]\s*)([A-Za-z_]\w*)\s*:", r'\1"\2":', literal)
+    # constants from other modules such as MAIN_COLOR
+    literal = re.sub(r"(:\s*)(?!true|false|null)[A-Za-z_]\w*", r"\1null", literal)
+    literal = re.sub(r",(\s*[}\]])", r"\1", literal)
+    return json.loads(literal)
+
+
+def _distance(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def _inside(rings, lon, lat):
+    """Even-odd rule over all rings, so holes are outside."""
+    inside = False
+    for ring in rings:
+        x, y = ring[:, 0], np.roll(ring[:, 0], 1)
+        u, v = ring[:, 1], np.roll(ring[:, 1], 1)
+        crosses = (u > lat) != (v > lat)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x_cross = (y - x) * (lat - u) / (v - u) + x
+        inside ^= bool(np.count_nonzero(crosses & (lon < x_cross)) % 2)
+    return inside
+
+
+class OfflineGeocoder:
+    """Reverse geocode points without network access.
+
+    A point close to a known location (an earlier geocoding result) gets that
+    location cut down to its city, e.g. "洛阳市, 河南省, 中国". Any other point
+    gets the province outline it lies in, e.g. "河南省, 中国".
+
+    Methods:
+        add_location: Remember the location string of a point.
+        nearby: City level location of the closest known location or None.
+        region: Province level location of a point or None.
+        reverse: nearby, else region.
+    """
+
+    def __init__(self, city_file=CITY_FILE, countries_file=RUN_COUNTRIES_FILE):
+        self.cities = {c["name"] for c in load_ts_literal(city_file)}
+        self.regions = []
+        bboxes = []
+        for feature in load_ts_literal(countries_file)["features"]:
+            geometry = feature["geometry"]
+            polygons = geometry["coordinates"]
+            if geometry["type"] == "Polygon":
+                polygons = [polygons]
+            elif geometry["type"] != "MultiPolygon":
+                continue
+            name = feature["properties"]["name"]
+            # province ids are only set for the parts of China
+            if "id" in feature["properties"]:
+                name = f"{name}, {CHINA}"
+            for polygon in polygons:
+                rings = [np.asarray(ring, dtype=np.float64) for ring in polygon]
+                outer = rings[0]
+                self.regions.append((name, rings))
+                bboxes.append((*outer.min(axis=0), *outer.max(axis=0)))
+        self.provinces = {name.split(", ")[0] for name, _ in self.regions}
+        # min lon, min lat, max lon, max lat of every outline
+        self.bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        self.grid = {}
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / GRID_DEGREES), math.floor(lon / GRID_DEGREES)
+
+    def city_location(self, location_country):
+        """The part of a location string from its city (or else province) on."""
+        parts = [
+            p.strip()
+            for p in location_country.split(",")
+            if p.strip() and not p.strip().isdigit()
+        ]
+        for names in (self.cities, self.provinces):
+            for i, part in enumerate(parts):
+                if part in names:
+                    return ", ".join(parts[i:])
+        return None
+
+    def add_location(self, lat, lon, location_country):
+        location = self.city_location(location_country or "")
+        if location:
+            self.grid.setdefault(self._cell(lat, lon), []).append((lat, lon, location))
+
+    def nearby(self, lat, lon, radius=KNOWN_LOCATION_RADIUS):
+        row, col = self._cell(lat, lon)
+        # enough cells to cover the radius also where longitude degrees are short
+        reach = math.ceil(
+            radius / (111000 * GRID_DEGREES * max(math.cos(math.radians(lat)), 0.1))
+        )
+        best, best_distance = None, radius
+        for i in range(row - 1, row + 2):
+            for j in range(col - reach, col + reach + 1):
+                for lat2, lon2, location in self.grid.get((i, j), ()):
+                    d = _distance(lat, lon, lat2, lon2)
+                    if d <= best_distance:
+                        best, best_distance = location, d
+        return best
+
+    def region(self, lat, lon):
+        b = self.bboxes
+        candidates = np.flatnonzero(
+            (b[:, 0] <= lon) & (lon <= b[:, 2]) & (b[:, 1] <= lat) & (lat <= b[:, 3])
+        )
+        for i in candidates:
+            name, rings = self.regions[i]
+            if _inside(rings, lon, lat):
+                return name
+        return None
+
+    def reverse(self, lat, lon):
+        return self.nearby(lat, lon) or self.region(lat, lon)
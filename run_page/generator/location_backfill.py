@@ -0,0 +1,88 @@
+"""
+Geocode the start points of saved activities apart from inserting them.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import GEOCODE_RATE, GEOCODE_WORKERS
+
+from .db import Activity, geocode_cache
+
+
+class TokenBucket:
+    """Let rate calls per second through on average, at most capacity at once."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            # take the token now, callers queue up behind a negative balance
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class LocationBackfill:
+    """Fill in location_country of activities that are already inserted.
+
+    Points the geocode cache knows are resolved right away. The others are
+    looked up online in the background, by at most max_workers threads, rate
+    requests per second and one request per S2 cell. finish() waits for them
+    and writes all locations with one executemany.
+    """
+
+    def __init__(
+        self, cache=geocode_cache, max_workers=GEOCODE_WORKERS, rate=GEOCODE_RATE
+    ):
+        self.cache = cache
+        self.max_workers = max_workers
+        self.bucket = TokenBucket(rate)
+        self.executor = None
+        # online lookups by cell id
+        self.requests = {}
+        # (run_id, lat, lon, location, cell_id, location_country) of every activity
+        self.pending = []
+
+    def submit(self, session, run_id, lat, lon, location_country=""):
+        """Queue an activity, location_country is kept when no location is found."""
+        location, cell_id = self.cache.resolve(session, lat, lon)
+        if location is None and self.cache.online and cell_id not in self.requests:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.max_workers)
+            self.requests[cell_id] = self.executor.submit(
+                self.cache.reverse_online, lat, lon, self.bucket.acquire
+            )
+        self.pending.append((run_id, lat, lon, location, cell_id, location_country))
+
+    def finish(self, session):
+        """Wait for the online lookups and update the activities, returns how many changed."""
+        rows = []
+        for run_id, lat, lon, location, cell_id, location_country in self.pending:
+            if location is None and cell_id in self.requests:
+                location = self.requests[cell_id].result()
+                if location is not None and cell_id not in self.cache.locations:
+                    self.cache.store(session, cell_id, lat, lon, location)
+            location = location or self.cache.region(session, lat, lon)
+            if location and location != location_country:
+                rows.append({"run_id": run_id, "location_country": location})
+        if rows:
+            session.bulk_update_mappings(Activity, rows)
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.requests = {}
+        self.pending = []
+        return len(rows)
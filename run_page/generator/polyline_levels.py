@@ -0,0 +1,105 @@
+"""
+Level of detail pyramid of the saved polylines: level i of activity_polylines
+is level 0 simplified to POLYLINE_LEVELS[i - 1] meters. The levels are built
+the first time an export or poster asks for one and brought up to date from
+the change log after that.
+"""
+
+import json
+
+import numpy as np
+from config import POLYLINE_LEVELS
+from polyline_codec import decode_many, encode_many
+from polyline_simplify import simplify
+from sqlalchemy import func
+
+from .db import (
+    ActivityChange,
+    ActivityPolyline,
+    ExportState,
+    _chunks,
+    decompress_polyline,
+    polyline_columns,
+    save_export_state,
+)
+
+# name of the export_state row of the levels
+POLYLINE_LEVELS_STATE = "polyline_levels"
+
+
+def coarsest_level(max_distance):
+    """Coarsest level no more than max_distance meters off, 0 for the saved one."""
+    level = 0
+    for i, tolerance in enumerate(POLYLINE_LEVELS, 1):
+        if tolerance <= max_distance:
+            level = i
+    return level
+
+
+def simplify_polylines(polyline_strs):
+    """[level 1, level 2, ... polyline] of every polyline of polyline_strs."""
+    coords, offsets = decode_many(polyline_strs)
+    parts = []
+    part_offsets = [0]
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        points = coords[start:end]
+        for tolerance in POLYLINE_LEVELS:
+            kept = points[simplify(points[:, 0], points[:, 1], tolerance)]
+            parts.append(kept)
+            part_offsets.append(part_offsets[-1] + len(kept))
+    if not parts:
+        return [[] for _ in polyline_strs]
+    encoded = encode_many(np.concatenate(parts), part_offsets)
+    count = len(POLYLINE_LEVELS)
+    return [encoded[i : i + count] for i in range(0, len(encoded), count)]
+
+
+def update_polyline_levels(session):
+    """Simplify the polylines changed since the last update again.
+
+    All polylines are simplified again when the levels were never built or
+    POLYLINE_LEVELS changed. The caller commits.
+
+    Returns:
+        The number of simplified polylines.
+    """
+    change_seq = session.query(func.max(ActivityChange.seq)).scalar() or 0
+    options = json.dumps(POLYLINE_LEVELS)
+    state = session.get(ExportState, POLYLINE_LEVELS_STATE)
+    saved = session.query(ActivityPolyline.run_id, ActivityPolyline.polyline).filter(
+        ActivityPolyline.level == 0
+    )
+    if state is None or state.options != options:
+        session.query(ActivityPolyline).filter(ActivityPolyline.level > 0).delete()
+        rows = saved.all()
+    else:
+        run_ids = sorted(
+            {
+                run_id
+                for (run_id,) in session.query(ActivityChange.run_id).filter(
+                    ActivityChange.seq > state.change_seq
+                )
+            }
+        )
+        if not run_ids:
+            return 0
+        rows = []
+        for chunk in _chunks(run_ids):
+            session.query(ActivityPolyline).filter(
+                ActivityPolyline.run_id.in_(chunk), ActivityPolyline.level > 0
+            ).delete()
+            rows.extend(saved.filter(ActivityPolyline.run_id.in_(chunk)))
+
+    for chunk in _chunks(rows):
+        levels = simplify_polylines([decompress_polyline(data) for _, data in chunk])
+        session.bulk_insert_mappings(
+            ActivityPolyline,
+            [
+                {"run_id": run_id, "level": level, **polyline_columns(p)}
+                for (run_id, _), polylines in zip(chunk, levels)
+                for level, p in enumerate(polylines, 1)
+            ],
+        )
+
+    save_export_state(session, POLYLINE_LEVELS_STATE, options, change_seq)
+    return len(rows)
@@ -0,0 +1,178 @@
+"""
+Daily totals and running streaks of the activities, kept in SQLite and
+brought up to date from the change log.
+"""
+
+import datetime
+import json
+
+from config import MAPPING_TYPE
+from sqlalchemy import and_, func
+
+from .db import (
+    Activity,
+    ActivityChange,
+    ExportState,
+    RollupActivity,
+    RollupDay,
+    _chunks,
+    save_export_state,
+)
+
+# the activities of Generator.load(), load() with only_run and loadForMapping()
+ROLLUP_SCOPES = {
+    "activities": Activity.distance > 0.1,
+    "runs": and_(Activity.distance > 0.1, Activity.type == "Run"),
+    "mapping": Activity.type.in_(MAPPING_TYPE),
+}
+# name of the export_state row of the rollups
+ROLLUP_STATE = "rollups"
+
+_local_day = func.substr(Activity.start_date_local, 1, 10)
+
+
+def with_streaks(query, scope):
+    """Add the running streak of every activity of scope to an Activity query."""
+    return query.outerjoin(
+        RollupDay, and_(RollupDay.scope == scope, RollupDay.day == _local_day)
+    ).add_columns(RollupDay.streak)
+
+
+def _options():
+    return json.dumps(
+        {
+            scope: str(condition.compile(compile_kwargs={"literal_binds": True}))
+            for scope, condition in ROLLUP_SCOPES.items()
+        },
+        sort_keys=True,
+    )
+
+
+def _update_days(session, scope, condition, days):
+    """Sum up the activities of scope again on days, all days when None."""
+    totals = (
+        session.query(
+            _local_day,
+            func.count(),
+            func.sum(Activity.distance),
+            func.sum(Activity.moving_seconds),
+        )
+        .filter(condition)
+        .group_by(_local_day)
+    )
+    if days is None:
+        rows = totals.all()
+    else:
+        rows = []
+        for chunk in _chunks(sorted(days)):
+            session.query(RollupDay).filter(
+                RollupDay.scope == scope, RollupDay.day.in_(chunk)
+            ).delete()
+            # the range keeps the scan on ix_activities_start_date_local
+            end = datetime.date.fromisoformat(chunk[-1]) + datetime.timedelta(days=1)
+            rows.extend(
+                totals.filter(
+                    Activity.start_date_local >= chunk[0],
+                    Activity.start_date_local < end.isoformat(),
+                    _local_day.in_(chunk),
+                )
+            )
+    session.bulk_insert_mappings(
+        RollupDay,
+        [
+            {
+                "scope": scope,
+                "day": day,
+                "count": count,
+                "distance": distance or 0,
+                "moving_time": moving_time or 0,
+            }
+            for day, count, distance, moving_time in rows
+            if day
+        ],
+    )
+
+
+def _update_streaks(session, scope, first_day, last_day):
+    """Streaks of the days from first_day on, until unchanged after last_day."""
+    day_before = (
+        datetime.date.fromisoformat(first_day) - datetime.timedelta(days=1)
+    ).isoformat()
+    rows = (
+        session.query(RollupDay)
+        .filter(RollupDay.scope == scope, RollupDay.day >= day_before)
+        .order_by(RollupDay.day)
+    )
+    streak = 0
+    last_date = None
+    for row in rows:
+        date = datetime.date.fromisoformat(row.day)
+        if row.day == day_before:
+            streak = row.streak
+        else:
+            if last_date is not None and date == last_date + datetime.timedelta(days=1):
+                streak += 1
+            else:
+                streak = 1
+            if row.streak == streak and row.day > last_day:
+                break
+            row.streak = streak
+        last_date = date
+
+
+def update_rollups(session):
+    """Sum up the days of the activities changed since the last update again.
+
+    Everything is summed up again when the rollups were never built or the
+    scopes changed. The caller commits.
+
+    Returns:
+        The number of days summed up again.
+    """
+    change_seq = session.query(func.max(ActivityChange.seq)).scalar() or 0
+    options = _options()
+    state = session.get(ExportState, ROLLUP_STATE)
+    activity_days = session.query(Activity.run_id, _local_day)
+    if state is None or state.options != options:
+        for model in (RollupDay, RollupActivity):
+            session.query(model).delete()
+        run_ids = None
+        old_days = set()
+        new_rows = activity_days.all()
+    else:
+        run_ids = sorted(
+            {
+                run_id
+                for (run_id,) in session.query(ActivityChange.run_id).filter(
+                    ActivityChange.seq > state.change_seq
+                )
+            }
+        )
+        if not run_ids:
+            return 0
+        old_days = set()
+        new_rows = []
+        for chunk in _chunks(run_ids):
+            old_days.update(
+                day
+                for (day,) in session.query(RollupActivity.day).filter(
+                    RollupActivity.run_id.in_(chunk)
+                )
+            )
+            session.query(RollupActivity).filter(
+                RollupActivity.run_id.in_(chunk)
+            ).delete()
+            new_rows.extend(activity_days.filter(Activity.run_id.in_(chunk)))
+    session.bulk_insert_mappings(
+        RollupActivity,
+        [{"run_id": run_id, "day": day} for run_id, day in new_rows if day],
+    )
+    days = old_days | {day for _, day in new_rows if day}
+
+    if days:
+        for scope, condition in ROLLUP_SCOPES.items():
+            _update_days(session, scope, condition, None if run_ids is None else days)
+            _update_streaks(session, scope, min(days), max(days))
+
+    save_export_state(session, ROLLUP_STATE, options, change_seq)
+    return len(days)
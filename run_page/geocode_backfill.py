@@ -0,0 +1,65 @@
+"""
+Fill in the location of saved activities that have none yet
+"""
+
+import argparse
+
+from config import GEOCODE_RATE, GEOCODE_WORKERS, JSON_FILE, SQL_FILE
+from generator import Generator
+from generator.db import Activity, ActivityPolyline, decompress_polyline, geocode_cache
+from generator.location_backfill import LocationBackfill
+from sqlalchemy import or_
+
+from polyline_codec import first_point
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--online",
+        action="store_true",
+        help="ask Nominatim for start points the offline geocoder has no city for",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=GEOCODE_RATE,
+        help="online requests per second",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=GEOCODE_WORKERS,
+        help="online requests at the same time",
+    )
+    options = parser.parse_args()
+
+    generator = Generator(SQL_FILE)
+    session = generator.session
+    if options.online:
+        geocode_cache.online = True
+    activities = (
+        session.query(
+            Activity.run_id, ActivityPolyline.polyline, Activity.location_country
+        )
+        .outerjoin(Activity.polyline)
+        .filter(
+            or_(
+                Activity.location_country.is_(None),
+                Activity.location_country == "",
+                # or China for #176 to fix
+                Activity.location_country == "China",
+            )
+        )
+        .all()
+    )
+    location_backfill = LocationBackfill(max_workers=options.workers, rate=options.rate)
+    for run_id, polyline, location_country in activities:
+        point = first_point(decompress_polyline(polyline))
+        if point:
+            location_backfill.submit(session, run_id, *point, location_country or "")
+    located = location_backfill.finish(session)
+    session.commit()
+    print(f"located {located} of {len(activities)} activities, {geocode_cache.stats()}")
+
+    if located:
+        generator.write_activities_file(JSON_FILE)
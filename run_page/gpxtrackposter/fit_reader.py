@@ -0,0 +1,351 @@
+"""Memory mapped FIT reader that decodes only what a Track needs"""
+
+# Copyright 2016-2019 Florian Pigorsch & Contributors. All rights reserved.
+# 2019-now yihong0618 Florian Pigorsch & Contributors. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import math
+import mmap
+import struct
+
+import numpy as np
+from garmin_fit_sdk import Decoder, Profile, Stream
+from garmin_fit_sdk.fit import (
+    BASE_TYPE_DEFINITIONS,
+    BASE_TYPE_MASK,
+    DEV_DATA_MASK,
+    LOCAL_MESG_NUM_MASK,
+    MESG_DEFINITION_MASK,
+    NUMERIC_FIELD_TYPES,
+)
+from garmin_fit_sdk.util import FIT_EPOCH_S
+
+SESSION_MESG_NUM = 18
+RECORD_MESG_NUM = 20
+DEVICE_INFO_MESG_NUM = 23
+
+# the session and device_info fields Track._load_fit_data looks at
+SESSION_FIELDS = {
+    2: "start_time",
+    5: "sport",
+    7: "total_elapsed_time",
+    8: "total_timer_time",
+    9: "total_distance",
+    14: "avg_speed",
+    16: "avg_heart_rate",
+    59: "total_moving_time",
+    124: "enhanced_avg_speed",
+}
+DEVICE_INFO_FIELDS = {0: "device_index", 2: "manufacturer", 4: "product"}
+# record fields decoded into columns, altitude expands into enhanced_altitude
+# and replaces it when valid
+RECORD_FIELDS = {
+    253: "timestamp",
+    0: "position_lat",
+    1: "position_long",
+    2: "altitude",
+    78: "altitude",
+    3: "heart_rate",
+    5: "distance",
+}
+RECORD_COLUMNS = (
+    "timestamp",
+    "position_lat",
+    "position_long",
+    "altitude",
+    "heart_rate",
+    "distance",
+)
+
+_COMPRESSED_HEADER_MASK = 0x80
+_CRC_SIZE = 2
+# how much of a file sniff_start_time() looks at
+SNIFF_BYTES = 1 << 18
+
+
+class _Unsupported(Exception):
+    """The file uses a FIT feature the fast path leaves to the SDK decoder."""
+
+
+class _Definition:
+    __slots__ = ("global_mesg_num", "endian", "fields", "size", "offsets")
+
+    def __init__(self, global_mesg_num, endian, fields, size):
+        self.global_mesg_num = global_mesg_num
+        self.endian = endian
+        # (field definition number, offset in the message, size, base type)
+        self.fields = fields
+        self.size = size
+        self.offsets = []
+
+
+class FITData:
+    """What is left of a FIT file after read_fit().
+
+    Attributes:
+        session: The first session message with the SDK's field names and values.
+        device_infos: The device_info messages, same format as session.
+        records: Float64 column per RECORD_COLUMNS entry, NaN where a record
+            has no valid value. Positions stay in semicircles.
+        errors: Errors reported by the SDK decoder.
+    """
+
+    def __init__(self):
+        self.session = None
+        self.device_infos = []
+        self.records = {name: np.empty(0) for name in RECORD_COLUMNS}
+        self.errors = []
+
+    @classmethod
+    def from_messages(cls, messages, errors=()):
+        """Build from the messages of garmin_fit_sdk Decoder.read()."""
+        fit = cls()
+        sessions = messages.get("session_mesgs")
+        fit.session = sessions[0] if sessions else None
+        fit.device_infos = messages.get("device_info_mesgs", [])
+        records = messages.get("record_mesgs", [])
+        for name in RECORD_COLUMNS:
+            if name == "altitude":
+                values = [
+                    r.get("enhanced_altitude", r.get("altitude", math.nan))
+                    for r in records
+                ]
+            else:
+                values = [r.get(name, math.nan) for r in records]
+            fit.records[name] = np.array(
+                [math.nan if v is None else v for v in values], dtype=np.float64
+            )
+        fit.errors = list(errors)
+        return fit
+
+
+def _value(field, raw):
+    """Convert a raw value the way the SDK Decoder does with its default options."""
+    types = Profile["types"].get(field["type"])
+    if types is not None:
+        return types.get(raw, raw)
+    if field["type"] in NUMERIC_FIELD_TYPES and len(field["scale"]) == 1:
+        scale, offset = field["scale"][0], field["offset"][0]
+        return (raw / scale if scale != 1 else raw) - offset
+    return raw
+
+
+def _raw_values(mm, definition, pos, wanted):
+    """Valid raw values of the wanted fields of one message, by field number."""
+    values = {}
+    for num, offset, size, base_type in definition.fields:
+        if num not in wanted:
+            continue
+        base = BASE_TYPE_DEFINITIONS[base_type]
+        if size != base["size"] or base["type_code"] == "s":
+            raise _Unsupported(f"field {num} of message {definition.global_mesg_num}")
+        raw = struct.unpack_from(
+            definition.endian + base["type_code"], mm, pos + offset
+        )[0]
+        if raw != base["invalid"]:
+            values[num] = raw
+    return values
+
+
+def _decode_session(mm, definition, pos):
+    fields = Profile["messages"][SESSION_MESG_NUM]["fields"]
+    raw = _raw_values(mm, definition, pos, SESSION_FIELDS)
+    message = {SESSION_FIELDS[num]: _value(fields[num], v) for num, v in raw.items()}
+    # avg_speed is a component of enhanced_avg_speed and replaces it when valid
+    if 14 in raw:
+        speed = raw[14] / fields[14]["scale"][0] - fields[14]["offset"][0]
+        message["enhanced_avg_speed"] = int(speed) if speed.is_integer() else speed
+    return message
+
+
+def _decode_device_info(mm, definition, pos):
+    fields = Profile["messages"][DEVICE_INFO_MESG_NUM]["fields"]
+    raw = _raw_values(mm, definition, pos, DEVICE_INFO_FIELDS)
+    message = {
+        DEVICE_INFO_FIELDS[num]: _value(fields[num], v) for num, v in raw.items()
+    }
+    if 4 in raw and 2 in raw:
+        for sub_field in fields[4]["sub_fields"]:
+            if any(m["raw_value"] == raw[2] for m in sub_field["map"]):
+                message[sub_field["name"]] = _value(sub_field, raw[4])
+    return message
+
+
+def _gather(mm, offsets, size):
+    """Copy the messages starting at offsets into an (n, size) byte array."""
+    buf = np.frombuffer(mm, dtype=np.uint8)
+    try:
+        return buf[np.asarray(offsets, dtype=np.int64)[:, None] + np.arange(size)]
+    finally:
+        # the mmap can only be closed once no array points into it
+        del buf
+
+
+def _decode_records(mm, definitions):
+    """Column arrays of all record messages, in file order."""
+    fields = Profile["messages"][RECORD_MESG_NUM]["fields"]
+    columns = {name: [] for name in RECORD_COLUMNS}
+    positions = []
+    for definition in definitions:
+        n = len(definition.offsets)
+        rows = _gather(mm, definition.offsets, definition.size)
+        decoded = {name: np.full(n, np.nan) for name in RECORD_COLUMNS}
+        # field 78 before 2, like the component expansion of the SDK
+        for num, offset, size, base_type in sorted(
+            definition.fields, key=lambda f: f[0] == 2
+        ):
+            if num not in RECORD_FIELDS:
+                continue
+            base = BASE_TYPE_DEFINITIONS[base_type]
+            if size != base["size"] or base["type_code"] == "s":
+                raise _Unsupported(f"record field {num}")
+            dtype = np.dtype(definition.endian + base["type_code"])
+            raw = np.ascontiguousarray(rows[:, offset : offset + size]).view(dtype)
+            raw = raw.ravel()
+            valid = raw != base["invalid"]
+            values = raw.astype(np.float64)
+            field = fields[num]
+            scale, field_offset = field["scale"][0], field["offset"][0]
+            if scale != 1:
+                values /= scale
+            values -= field_offset
+            column = decoded[RECORD_FIELDS[num]]
+            column[valid] = values[valid]
+        for name in RECORD_COLUMNS:
+            columns[name].append(decoded[name])
+        positions.append(np.asarray(definition.offsets, dtype=np.int64))
+    if not positions:
+        return {name: np.empty(0) for name in RECORD_COLUMNS}
+    # records of different local message types are interleaved in the file
+    order = np.argsort(np.concatenate(positions), kind="stable")
+    return {name: np.concatenate(columns[name])[order] for name in RECORD_COLUMNS}
+
+
+def _read_header(buf):
+    """Offset of the first record and the end of the data records."""
+    header_size = buf[0]
+    if header_size not in (12, 14) or len(buf) < header_size + _CRC_SIZE:
+        raise _Unsupported("not a FIT file")
+    data_size = struct.unpack_from("<I", buf, 4)[0]
+    if buf[8:12] != b".FIT":
+        raise _Unsupported("not a FIT file")
+    return header_size, header_size + data_size
+
+
+def _read_definition(buf, pos):
+    """Parse the definition message at pos, return it and the next position."""
+    record_header = buf[pos]
+    endian = ">" if buf[pos + 2] else "<"
+    global_mesg_num = struct.unpack_from(endian + "H", buf, pos + 3)[0]
+    pos += 6
+    fields = []
+    size = 0
+    for _ in range(buf[pos - 1]):
+        num, field_size, base_type = buf[pos], buf[pos + 1], buf[pos + 2]
+        base_type &= BASE_TYPE_MASK
+        if base_type not in BASE_TYPE_DEFINITIONS:
+            raise _Unsupported("invalid base type")
+        fields.append((num, size, field_size, base_type))
+        size += field_size
+        pos += 3
+    if record_header & DEV_DATA_MASK:
+        # developer fields are skipped, only their size matters
+        num_dev_fields = buf[pos]
+        pos += 1
+        for _ in range(num_dev_fields):
+            size += buf[pos + 1]
+            pos += 3
+    return _Definition(global_mesg_num, endian, fields, size), pos
+
+
+def _read_mapped(mm):
+    pos, end = _read_header(mm)
+    if end + _CRC_SIZE != len(mm):
+        raise _Unsupported("chained or truncated FIT file")
+
+    fit = FITData()
+    definitions = {}
+    record_definitions = []
+    while pos < end:
+        record_header = mm[pos]
+        if record_header & _COMPRESSED_HEADER_MASK:
+            raise _Unsupported("compressed timestamp header")
+        local_mesg_num = record_header & LOCAL_MESG_NUM_MASK
+        if record_header & MESG_DEFINITION_MASK:
+            definition, pos = _read_definition(mm, pos)
+            definitions[local_mesg_num] = definition
+            if definition.global_mesg_num == RECORD_MESG_NUM:
+                record_definitions.append(definition)
+            continue
+
+        definition = definitions.get(local_mesg_num)
+        if definition is None or pos + 1 + definition.size > end:
+            raise _Unsupported("invalid message")
+        if definition.global_mesg_num == RECORD_MESG_NUM:
+            definition.offsets.append(pos + 1)
+        elif definition.global_mesg_num == SESSION_MESG_NUM:
+            if fit.session is None:
+                fit.session = _decode_session(mm, definition, pos + 1)
+        elif definition.global_mesg_num == DEVICE_INFO_MESG_NUM:
+            fit.device_infos.append(_decode_device_info(mm, definition, pos + 1))
+        pos += 1 + definition.size
+
+    fit.records = _decode_records(mm, [d for d in record_definitions if d.offsets])
+    return fit
+
+
+def sniff_start_time(file_name):
+    """UTC time of the first record, read from the head of the file only.
+
+    None when there is no record with a timestamp in the first SNIFF_BYTES.
+    """
+    with open(file_name, "rb") as f:
+        buf = f.read(SNIFF_BYTES)
+    try:
+        pos, end = _read_header(buf)
+        end = min(end, len(buf))
+        definitions = {}
+        while pos < end:
+            record_header = buf[pos]
+            if record_header & _COMPRESSED_HEADER_MASK:
+                return None
+            if record_header & MESG_DEFINITION_MASK:
+                definition, pos = _read_definition(buf, pos)
+                definitions[record_header & LOCAL_MESG_NUM_MASK] = definition
+                continue
+            definition = definitions.get(record_header & LOCAL_MESG_NUM_MASK)
+            if definition is None:
+                return None
+            if definition.global_mesg_num == RECORD_MESG_NUM:
+                timestamp = _raw_values(buf, definition, pos + 1, (253,)).get(253)
+                if timestamp is not None:
+                    return datetime.datetime.utcfromtimestamp(timestamp + FIT_EPOCH_S)
+            pos += 1 + definition.size
+    except (_Unsupported, struct.error, IndexError):
+        pass
+    return None
+
+
+def read_fit_sdk(file_name):
+    """Decode the whole file with garmin_fit_sdk."""
+    decoder = Decoder(Stream.from_file(file_name))
+    messages, errors = decoder.read(convert_datetimes_to_dates=False)
+    return FITData.from_messages(messages, errors)
+
+
+def read_fit(file_name):
+    """Walk the memory mapped file and decode session, record and device_info.
+
+    Record fields go straight into NumPy columns. Files with compressed
+    timestamp headers, chained files, array fields and anything else unusual
+    are handed to the SDK decoder. The CRC is not checked on the fast path.
+    """
+    with open(file_name, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            try:
+                return _read_mapped(mm)
+            except (_Unsupported, struct.error, IndexError):
+                pass
+    return read_fit_sdk(file_name)
@@ -0,0 +1,214 @@
+"""Single pass GPX reader that keeps only what a Track needs"""
+
+# Copyright 2016-2019 Florian Pigorsch & Contributors. All rights reserved.
+# 2019-now yihong0618 Florian Pigorsch & Contributors. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import math
+from array import array
+
+import numpy as np
+from gpxpy.gpxfield import parse_time
+from lxml import etree
+from polyline_simplify import SIMPLIFY_MAX_DISTANCE, simplify
+from track_metrics import length_2d, moving_data, point_distances
+
+NO_TIME = -(2**63)
+_EPOCH = datetime.datetime(1970, 1, 1)
+_ONE_US = datetime.timedelta(microseconds=1)
+
+
+def _localname(tag):
+    return tag.rsplit("}", 1)[-1] if isinstance(tag, str) else ""
+
+
+def _time_us(text):
+    """Microseconds since epoch, exact like timedelta arithmetic in gpxpy."""
+    if len(text) == 20 and text[19] == "Z":
+        return (datetime.datetime.fromisoformat(text[:19]) - _EPOCH) // _ONE_US
+    t = parse_time(text)
+    return (t.replace(tzinfo=None) - t.utcoffset() - _EPOCH) // _ONE_US
+
+
+class GPXSegment:
+    """Columns of one <trkseg>, missing values are NaN / NO_TIME / 0."""
+
+    __slots__ = ("lat", "lon", "ele", "time", "hr", "first_time", "last_time")
+
+    def __init__(self):
+        self.lat = array("d")
+        self.lon = array("d")
+        self.ele = array("d")
+        self.time = array("q")
+        self.hr = array("i")
+        self.first_time = None
+        self.last_time = None
+
+    def __len__(self):
+        return len(self.lat)
+
+    def length_2d(self):
+        """Same as gpxpy GPXTrackSegment.length_2d()."""
+        return length_2d(
+            np.frombuffer(self.lat, dtype=np.float64),
+            np.frombuffer(self.lon, dtype=np.float64),
+        )
+
+    def simplify(self, max_distance=SIMPLIFY_MAX_DISTANCE):
+        """Indices kept by gpxpy's Ramer-Douglas-Peucker simplify_polyline()."""
+        return simplify(
+            np.frombuffer(self.lat, dtype=np.float64),
+            np.frombuffer(self.lon, dtype=np.float64),
+            max_distance,
+        )
+
+    def moving_data(self, indices):
+        """(moving_time, stopped_time, moving_distance) like gpxpy get_moving_data()."""
+        if len(indices) < 2:
+            return 0.0, 0.0, 0.0
+        indices = np.asarray(indices)
+        time = np.frombuffer(self.time, dtype=np.int64)[indices]
+        seconds = np.diff(time) / 10**6
+        seconds[(time[1:] == NO_TIME) | (time[:-1] == NO_TIME)] = np.nan
+        distances = point_distances(
+            np.frombuffer(self.lat, dtype=np.float64)[indices],
+            np.frombuffer(self.lon, dtype=np.float64)[indices],
+            np.frombuffer(self.ele, dtype=np.float64)[indices],
+        )
+        return moving_data(distances, seconds)
+
+
+class GPXTrackData:
+    __slots__ = ("name", "type", "source", "number", "segments")
+
+    def __init__(self):
+        self.name = None
+        self.type = None
+        self.source = None
+        self.number = None
+        self.segments = []
+
+
+class GPXData:
+    """What is left of a GPX file after read_gpx()."""
+
+    def __init__(self):
+        self.creator = None
+        self.name = None
+        self.tracks = []
+
+    def get_time_bounds(self):
+        start_time = end_time = None
+        for t in self.tracks:
+            for s in t.segments:
+                if s.first_time is None:
+                    continue
+                if start_time is None:
+                    start_time = s.first_time
+                end_time = s.last_time
+        return (
+            parse_time(start_time) if start_time else None,
+            parse_time(end_time) if end_time else None,
+        )
+
+    def length_2d(self):
+        return sum(s.length_2d() for t in self.tracks for s in t.segments)
+
+
+def read_gpx(file_name):
+    """Stream the file with iterparse and drop every element once it is read."""
+    gpx = GPXData()
+    track = segment = None
+    lat = lon = ele = point_time = None
+    hr = 0
+    # localnames of the open elements
+    path = []
+    for event, elem in etree.iterparse(
+        file_name, events=("start", "end"), remove_comments=True, huge_tree=True
+    ):
+        name = _localname(elem.tag)
+        if event == "start":
+            path.append(name)
+            if name == "gpx" and len(path) == 1:
+                gpx.creator = elem.get("creator")
+            elif name == "trk":
+                track = GPXTrackData()
+                gpx.tracks.append(track)
+            elif name == "trkseg" and track is not None:
+                segment = GPXSegment()
+                track.segments.append(segment)
+            elif name == "trkpt":
+                lat = float(elem.get("lat"))
+                lon = float(elem.get("lon"))
+                ele, point_time, hr = math.nan, None, 0
+            continue
+
+        path.pop()
+        parent = path[-1] if path else None
+        if parent == "trkpt":
+            text = (elem.text or "").strip()
+            if name == "ele" and text:
+                ele = float(text)
+            elif name == "time" and text:
+                point_time = text
+        elif name == "trkpt":
+            if segment is not None:
+                segment.lat.append(lat)
+                segment.lon.append(lon)
+                segment.ele.append(ele)
+                segment.hr.append(hr)
+                if point_time:
+                    segment.time.append(_time_us(point_time))
+                    if segment.first_time is None:
+                        segment.first_time = point_time
+                    segment.last_time = point_time
+                else:
+                    segment.time.append(NO_TIME)
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        elif (
+            name == "hr"
+            and len(path) >= 3
+            and path[-2] == "extensions"
+            and path[-3] == "trkpt"
+        ):
+            # the first extension element decides, as in Track._load_gpx_data
+            first = elem.getparent().getparent()[0]
+            if elem.getparent() is first and elem.text:
+                hr = int(elem.text)
+        elif parent == "trk" and track is not None:
+            text = elem.text.strip() if elem.text else None
+            if name == "name":
+                track.name = text
+            elif name == "type":
+                track.type = text
+            elif name == "src":
+                track.source = text
+            elif name == "number" and text:
+                track.number = int(text)
+        elif name == "name" and (
+            parent == "gpx" or (parent == "metadata" and len(path) == 2)
+        ):
+            gpx.name = elem.text.strip() if elem.text else None
+        elif name in ("trk", "rte", "wpt", "metadata"):
+            elem.clear()
+    return gpx
+
+
+def sniff_start_time(file_name):
+    """Time of the first track point, the rest of the file is not read."""
+    for event, elem in etree.iterparse(
+        file_name, events=("end",), remove_comments=True, huge_tree=True
+    ):
+        name = _localname(elem.tag)
+        if name == "time":
+            text = (elem.text or "").strip()
+            parent = elem.getparent()
+            if text and parent is not None and _localname(parent.tag) == "trkpt":
+                return parse_time(text)
+        elif name in ("trkpt", "rte", "wpt", "metadata"):
+            elem.clear()
+    return None
@@ -0,0 +1,201 @@
+"""Single pass TCX reader that keeps only what a Track needs"""
+
+# Copyright 2016-2019 Florian Pigorsch & Contributors. All rights reserved.
+# 2019-now yihong0618 Florian Pigorsch & Contributors. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import math
+from array import array
+
+import numpy as np
+from lxml import etree
+
+TCD = "{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}"
+_ACTIVITY = TCD + "Activity"
+_ID = TCD + "Id"
+_LAP = TCD + "Lap"
+_TRACK = TCD + "Track"
+_TRACKPOINT = TCD + "Trackpoint"
+_TIME = TCD + "Time"
+_POSITION = TCD + "Position"
+_LATITUDE = TCD + "LatitudeDegrees"
+_LONGITUDE = TCD + "LongitudeDegrees"
+_VALUE = TCD + "Value"
+_DISTANCE = TCD + "DistanceMeters"
+
+# the formats tcxreader accepts, in its order
+TIME_FORMATS = (
+    "%Y-%m-%dT%H:%M:%S.%fZ",
+    "%Y-%m-%dT%H:%M:%S.%f%z",
+    "%Y-%m-%dT%H:%M:%SZ",
+    "%Y-%m-%dT%H:%M:%S%z",
+)
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def parse_time(text):
+    for pattern in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, pattern)
+        except ValueError:
+            continue
+    raise ValueError(f"Cannot parse time {text!r}")
+
+
+def _epoch_seconds(t):
+    """Seconds since epoch of a time text or datetime, naive times are UTC."""
+    try:
+        if isinstance(t, str):
+            if len(t) == 20 and t[19] == "Z":
+                t = datetime.datetime.fromisoformat(t[:19])
+            else:
+                t = parse_time(t)
+        if t.tzinfo is not None:
+            t = t.replace(tzinfo=None) - t.utcoffset()
+        return (t - _EPOCH).total_seconds()
+    except (ValueError, TypeError, AttributeError):
+        return math.nan
+
+
+def _float(text):
+    try:
+        return float(text)
+    except (ValueError, TypeError):
+        return math.nan
+
+
+class TCXData:
+    """Trackpoint columns of a TCX file, missing values are NaN.
+
+    Like tcxreader with only_gps, trackpoints without a longitude are dropped.
+
+    Attributes:
+        distance: Sum of the DistanceMeters of all laps.
+        time: Time text of every trackpoint, parsed on demand.
+        lat, lon, hr, point_distance: Per trackpoint columns.
+    """
+
+    def __init__(self):
+        self.distance = 0
+        self.time = []
+        self.lat = array("d")
+        self.lon = array("d")
+        self.hr = array("d")
+        self.point_distance = array("d")
+
+    def __len__(self):
+        return len(self.lon)
+
+    @classmethod
+    def from_exercise(cls, exercise):
+        """Build from a tcxreader TCXExercise."""
+        tcx = cls()
+        tcx.distance = exercise.distance
+        for p in exercise.trackpoints:
+            tcx.time.append(p.time)
+            tcx.lat.append(math.nan if p.latitude is None else p.latitude)
+            tcx.lon.append(p.longitude)
+            tcx.hr.append(math.nan if p.hr_value is None else p.hr_value)
+            tcx.point_distance.append(math.nan if p.distance is None else p.distance)
+        return tcx
+
+    def time_at(self, i):
+        t = self.time[i]
+        return parse_time(t) if isinstance(t, str) else t
+
+    def time_seconds(self):
+        """Seconds since epoch of every trackpoint, NaN when the time is missing."""
+        return np.array([_epoch_seconds(t) for t in self.time], dtype=np.float64)
+
+
+def read_tcx(file_name):
+    """Stream the leaf elements with iterparse, dropping every trackpoint once it is read.
+
+    Only elements of activities count, like in tcxreader, courses are skipped.
+    """
+    tcx = TCXData()
+    in_activity = in_point = False
+    time = None
+    lat = lon = hr = point_distance = math.nan
+    for event, elem in etree.iterparse(
+        file_name,
+        events=("start", "end"),
+        tag=(
+            _ACTIVITY,
+            _TRACKPOINT,
+            _LAP,
+            _TIME,
+            _LATITUDE,
+            _LONGITUDE,
+            _VALUE,
+            _DISTANCE,
+        ),
+        remove_comments=True,
+        huge_tree=True,
+    ):
+        tag = elem.tag
+        if event == "start":
+            if tag == _ACTIVITY:
+                in_activity = True
+            elif tag == _TRACKPOINT and in_activity:
+                in_point = True
+                time = None
+                lat = lon = hr = point_distance = math.nan
+            continue
+
+        if in_point:
+            if tag == _TIME:
+                time = elem.text
+            elif tag == _LATITUDE:
+                lat = _float(elem.text)
+            elif tag == _LONGITUDE:
+                lon = _float(elem.text)
+            elif tag == _VALUE:
+                hr = _float(elem.text)
+                hr = math.nan if hr != hr else int(hr)
+            elif tag == _DISTANCE:
+                point_distance = _float(elem.text)
+            elif tag == _TRACKPOINT:
+                in_point = False
+                # only trackpoints with a longitude are kept
+                if lon == lon:
+                    tcx.time.append(time)
+                    tcx.lat.append(lat)
+                    tcx.lon.append(lon)
+                    tcx.hr.append(hr)
+                    tcx.point_distance.append(point_distance)
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        elif tag == _DISTANCE:
+            if in_activity and elem.getparent().tag == _LAP:
+                tcx.distance += float(elem.text)
+        elif tag == _LAP:
+            elem.clear()
+        elif tag == _ACTIVITY:
+            in_activity = False
+            elem.clear()
+    return tcx
+
+
+def sniff_start_time(file_name):
+    """Activity Id, or else the StartTime of the first lap, without reading the trackpoints."""
+    for event, elem in etree.iterparse(
+        file_name, events=("start", "end"), tag=(_ID, _LAP), huge_tree=True
+    ):
+        if event == "end" and elem.tag == _ID:
+            parent = elem.getparent()
+            if parent is None or parent.tag != _ACTIVITY:
+                continue
+            text = elem.text
+        elif event == "start" and elem.tag == _LAP:
+            text = elem.get("StartTime")
+        else:
+            continue
+        try:
+            return parse_time((text or "").strip())
+        except ValueError:
+            continue
+    return None
@@ -11,21 +11,34 @@ from collections import namedtuple
 
 import gpxpy as mod_gpxpy
 import lxml
-import polyline
-import s2sphere as s2
-from garmin_fit_sdk import Decoder, Stream
+import numpy as np
 from garmin_fit_sdk.util import FIT_EPOCH_S
+from polyline_codec import decode_coords
 from polyline_processor import filter_out
+from polyline_simplify import SIMPLIFY_MAX_DISTANCE, simplify
 from rich import print
 from tcxreader.tcxreader import TCXReader
+from track_metrics import heart_rate_stats, track_moving_data
 
 from .exceptions import TrackLoadError
+from .fit_reader import read_fit, read_fit_sdk
+from .gpx_reader import NO_TIME, read_gpx
+from .tcx_reader import TCXData, read_tcx
+from .track_geometry import TrackGeometry
 from .utils import parse_datetime_to_local
 
 start_point = namedtuple("start_point", "lat lon")
 run_map = namedtuple("polyline", "summary_polyline")
 
 IGNORE_BEFORE_SAVING = os.getenv("IGNORE_BEFORE_SAVING", False)
+# "stream" reads GPX files with the single pass gpx_reader, "gpxpy" builds the full gpxpy tree
+GPX_READER = os.getenv("GPX_READER", "stream")
+# "mmap" decodes FIT files with fit_reader, "sdk" runs the full garmin_fit_sdk Decoder
+FIT_READER = os.getenv("FIT_READER", "mmap")
+# "stream" reads TCX files with the single pass tcx_reader, "tcxreader" builds every trackpoint object
+TCX_READER = os.getenv("TCX_READER", "stream")
+# meters a simplified GPX track may be off the recorded one, 10 as in gpxpy simplify()
+GPX_SIMPLIFY_DISTANCE = float(os.getenv("GPX_SIMPLIFY_DISTANCE", SIMPLIFY_MAX_DISTANCE))
 
 # Garmin stores all latitude and longitude values as 32-bit integer values.
 # This unit is called semicircle.
@@ -36,10 +49,31 @@ SEMICIRCLE = 11930465
 
 
 class Track:
+    __slots__ = (
+        "file_names",
+        "_geometry",
+        "_polyline_str",
+        "start_time",
+        "end_time",
+        "start_time_local",
+        "end_time_local",
+        "length",
+        "special",
+        "average_heartrate",
+        "_moving_dict",
+        "_appended",
+        "run_id",
+        "start_latlng",
+        "type",
+        "source",
+        "name",
+        "load_error",
+    )
+
     def __init__(self):
         self.file_names = []
-        self.polylines = []
-        self.polyline_str = ""
+        self._geometry = TrackGeometry()
+        self._polyline_str = ""
         self.start_time = None
         self.end_time = None
         self.start_time_local = None
@@ -47,12 +81,49 @@ class Track:
         self.length = 0
         self.special = False
         self.average_heartrate = None
-        self.moving_dict = {}
+        self._moving_dict = {}
+        # tracks appended since geometry and moving_dict were last combined
+        self._appended = []
         self.run_id = 0
         self.start_latlng = []
         self.type = "Run"
         self.source = ""
         self.name = ""
+        # why load_gpx/load_tcx/load_fit failed, None when the file loaded
+        self.load_error = None
+
+    @property
+    def geometry(self):
+        if self._appended:
+            self._combine_appended()
+        return self._geometry
+
+    @geometry.setter
+    def geometry(self, geometry):
+        self._geometry = geometry
+
+    @property
+    def polyline_str(self):
+        """Encoded polyline of geometry, encoded on first use after an append."""
+        if self._appended:
+            self._combine_appended()
+        if self._polyline_str is None:
+            self._polyline_str = self._geometry.encode()
+        return self._polyline_str
+
+    @polyline_str.setter
+    def polyline_str(self, polyline_str):
+        self._polyline_str = polyline_str
+
+    @property
+    def moving_dict(self):
+        if self._appended:
+            self._combine_appended()
+        return self._moving_dict
+
+    @moving_dict.setter
+    def moving_dict(self, moving_dict):
+        self._moving_dict = moving_dict
 
     def load_gpx(self, file_name):
         """
@@ -64,29 +135,36 @@ class Track:
             # (for example, treadmill runs pulled via garmin-connect-export)
             if os.path.getsize(file_name) == 0:
                 raise TrackLoadError("Empty GPX file")
-            with open(file_name, "rb") as file:
-                self._load_gpx_data(mod_gpxpy.parse(file))
+            if GPX_READER == "gpxpy":
+                with open(file_name, "rb") as file:
+                    self._load_gpx_data(mod_gpxpy.parse(file))
+            else:
+                self._load_gpx_reader_data(read_gpx(file_name))
         except Exception as e:
             print(
                 f"Something went wrong when loading GPX. for file {self.file_names[0]}, we just ignore this file and continue"
             )
             print(str(e))
-            pass
+            self.load_error = f"{type(e).__name__}: {e}"
 
     def load_tcx(self, file_name):
         try:
             self.file_names = [os.path.basename(file_name)]
             # Handle empty tcx files
             # (for example, treadmill runs pulled via garmin-connect-export)
-            tcx = TCXReader()
             if os.path.getsize(file_name) == 0:
                 raise TrackLoadError("Empty TCX file")
-            self._load_tcx_data(tcx.read(file_name), file_name=file_name)
+            if TCX_READER == "tcxreader":
+                tcx = TCXData.from_exercise(TCXReader().read(file_name))
+            else:
+                tcx = read_tcx(file_name)
+            self._load_tcx_data(tcx, file_name=file_name)
         except Exception as e:
             print(
                 f"Something went wrong when loading TCX. for file {self.file_names[0]}, we just ignore this file and continue"
             )
             print(str(e))
+            self.load_error = f"{type(e).__name__}: {e}"
 
     def load_fit(self, file_name):
         try:
@@ -95,19 +173,29 @@ class Track:
             # (for example, treadmill runs pulled via garmin-connect-export)
             if os.path.getsize(file_name) == 0:
                 raise TrackLoadError("Empty FIT file")
-            stream = Stream.from_file(file_name)
-            decoder = Decoder(stream)
-            messages, errors = decoder.read(convert_datetimes_to_dates=False)
-            if errors:
-                print(f"FIT file read fail: {errors}")
-            self._load_fit_data(messages)
+            if FIT_READER == "sdk":
+                fit = read_fit_sdk(file_name)
+            else:
+                fit = read_fit(file_name)
+            if fit.errors:
+                print(f"FIT file read fail: {fit.errors}")
+            self._load_fit_data(fit)
         except Exception as e:
             print(
                 f"Something went wrong when loading FIT. for file {self.file_names[0]}, we just ignore this file and continue"
             )
             print(str(e))
+            self.load_error = f"{type(e).__name__}: {e}"
+
+    @staticmethod
+    def polyline_from_db(activity, privacy_filter=filter_out, level=0):
+        """summary_polyline of activity as drawn, filtered with IGNORE_BEFORE_SAVING."""
+        summary_polyline = activity.summary_polyline_at(level)
+        if IGNORE_BEFORE_SAVING:
+            return privacy_filter(summary_polyline)
+        return summary_polyline
 
-    def load_from_db(self, activity):
+    def load_from_db(self, activity, privacy_filter=filter_out, geometry=None):
         # use strava as file name
         self.file_names = [str(activity.run_id)]
         start_time = datetime.datetime.strptime(
@@ -116,21 +204,15 @@ class Track:
         self.start_time_local = start_time
         self.end_time = start_time + activity.elapsed_time
         self.length = float(activity.distance)
-        if IGNORE_BEFORE_SAVING:
-            summary_polyline = filter_out(activity.summary_polyline)
-        else:
-            summary_polyline = activity.summary_polyline
-        polyline_data = polyline.decode(summary_polyline) if summary_polyline else []
-        self.polylines = [[s2.LatLng.from_degrees(p[0], p[1]) for p in polyline_data]]
+        if geometry is None:
+            summary_polyline = self.polyline_from_db(activity, privacy_filter)
+            geometry = TrackGeometry.from_points(decode_coords(summary_polyline or ""))
+        self.geometry = geometry
         self.run_id = activity.run_id
 
     def bbox(self):
         """Compute the smallest rectangle that contains the entire track (border box)."""
-        bbox = s2.LatLngRect()
-        for line in self.polylines:
-            for latlng in line:
-                bbox = bbox.union(s2.LatLngRect.from_point(latlng.normalized()))
-        return bbox
+        return self.geometry.bbox()
 
     @staticmethod
     def __make_run_id(time_stamp):
@@ -138,40 +220,35 @@ class Track:
 
     def _load_tcx_data(self, tcx, file_name):
         self.length = float(tcx.distance)
-        time_values = [i.time for i in tcx.trackpoints]
-        if not time_values:
+        if not len(tcx):
             raise TrackLoadError("Track is empty.")
 
-        self.start_time, self.end_time = time_values[0], time_values[-1]
-        moving_time = int(self.end_time.timestamp() - self.start_time.timestamp())
+        self.start_time, self.end_time = tcx.time_at(0), tcx.time_at(-1)
+        elapsed_time = int(self.end_time.timestamp() - self.start_time.timestamp())
+        moving_time = (
+            track_moving_data(tcx.lat, tcx.lon, tcx.time_seconds())[0] or elapsed_time
+        )
         self.run_id = self.__make_run_id(self.start_time)
-        self.average_heartrate = tcx.hr_avg
-        polyline_container = []
-        position_values = [(i.latitude, i.longitude) for i in tcx.trackpoints]
-        if not position_values and int(self.length) == 0:
+        self.average_heartrate = heart_rate_stats(tcx.hr)[0]
+        if not len(tcx) and int(self.length) == 0:
             raise Exception(
                 f"This {file_name} TCX file do not contain distance and position values we ignore it"
             )
-        if position_values:
-            line = [s2.LatLng.from_degrees(p[0], p[1]) for p in position_values]
-            self.polylines.append(line)
-            polyline_container.extend([[p[0], p[1]] for p in position_values])
-            self.polyline_container = polyline_container
+        if len(tcx):
+            self.geometry = TrackGeometry.from_segments([(tcx.lat, tcx.lon)])
             self.start_time_local, self.end_time_local = parse_datetime_to_local(
-                self.start_time, self.end_time, polyline_container[0]
+                self.start_time, self.end_time, self.geometry.first_point()
             )
             # get start point
             try:
-                self.start_latlng = start_point(*polyline_container[0])
+                self.start_latlng = start_point(*self.geometry.first_point())
             except:
                 pass
-            self.polyline_str = polyline.encode(polyline_container)
+            self.polyline_str = self.geometry.encode()
         self.moving_dict = {
             "distance": self.length,
             "moving_time": datetime.timedelta(seconds=moving_time),
-            "elapsed_time": datetime.timedelta(
-                seconds=moving_time
-            ),  # FIXME for now make it same as moving time
+            "elapsed_time": datetime.timedelta(seconds=elapsed_time),
             "average_speed": self.length / moving_time if moving_time else 0,
         }
 
@@ -186,8 +263,15 @@ class Track:
         self.length = gpx.length_2d()
         if self.length == 0:
             raise TrackLoadError("Track is empty.")
-        gpx.simplify()
-        polyline_container = []
+        for t in gpx.tracks:
+            for s in t.segments:
+                kept = simplify(
+                    [p.latitude for p in s.points],
+                    [p.longitude for p in s.points],
+                    GPX_SIMPLIFY_DISTANCE,
+                )
+                s.points = [s.points[i] for i in kept]
+        segments = []
         heart_rate_list = []
         # determinate type
         if gpx.tracks[0].type:
@@ -230,31 +314,103 @@ class Track:
                     heart_rate_list = list(filter(None, heart_rate_list))
                 except:
                     pass
-                line = [
-                    s2.LatLng.from_degrees(p.latitude, p.longitude) for p in s.points
-                ]
-                self.polylines.append(line)
-                polyline_container.extend([[p.latitude, p.longitude] for p in s.points])
-                self.polyline_container = polyline_container
+                segments.append([(p.latitude, p.longitude) for p in s.points])
+        self.geometry = TrackGeometry.from_segments(segments)
         # get start point
         try:
-            self.start_latlng = start_point(*polyline_container[0])
+            self.start_latlng = start_point(*self.geometry.first_point())
         except:
             pass
         if not self.start_time_local:
             self.start_time_local, self.end_time_local = parse_datetime_to_local(
-                self.start_time, self.end_time, polyline_container[0]
+                self.start_time, self.end_time, self.geometry.first_point()
             )
-        self.polyline_str = polyline.encode(polyline_container)
-        self.average_heartrate = (
-            sum(heart_rate_list) / len(heart_rate_list) if heart_rate_list else None
-        )
+        self.polyline_str = self.geometry.encode()
+        self.average_heartrate = heart_rate_stats(heart_rate_list)[0]
         self.moving_dict = self._get_moving_data(gpx)
 
-    def _load_fit_data(self, fit: dict):
-        _polylines = []
-        self.polyline_container = []
-        message = fit["session_mesgs"][0]
+    def _load_gpx_reader_data(self, gpx):
+        """Same fields as _load_gpx_data, from the columns of gpx_reader.read_gpx"""
+        self.start_time, self.end_time = gpx.get_time_bounds()
+        if self.start_time is None:
+            raise TrackLoadError("Track has no start time.")
+        if self.end_time is None:
+            raise TrackLoadError("Track has no end time.")
+        # use timestamp as id
+        self.run_id = self.__make_run_id(self.start_time)
+        self.length = gpx.length_2d()
+        if self.length == 0:
+            raise TrackLoadError("Track is empty.")
+        first_track = gpx.tracks[0]
+        # determinate type
+        if first_track.type:
+            self.type = first_track.type
+        # determinate source
+        if gpx.creator:
+            self.source = gpx.creator
+        if first_track.source:
+            self.source = first_track.source
+        if self.source == "xingzhe":
+            self.start_time_local = self.start_time
+            self.end_time_local = self.end_time
+            self.run_id = first_track.number
+        # determinate name
+        if gpx.name:
+            self.name = gpx.name
+        elif first_track.name:
+            self.name = first_track.name
+        else:
+            self.name = self.type + " from " + self.source
+
+        segments, times, elevations, heart_rates = [], [], [], []
+        moving_time = stopped_time = moving_distance = 0.0
+        for t in gpx.tracks:
+            for s in t.segments:
+                kept = s.simplify(GPX_SIMPLIFY_DISTANCE)
+                segment_moving_data = s.moving_data(kept)
+                moving_time += segment_moving_data[0]
+                stopped_time += segment_moving_data[1]
+                moving_distance += segment_moving_data[2]
+                if not len(kept):
+                    continue
+                segments.append(
+                    (
+                        np.frombuffer(s.lat, dtype=np.float64)[kept],
+                        np.frombuffer(s.lon, dtype=np.float64)[kept],
+                    )
+                )
+                times.append(np.frombuffer(s.time, dtype=np.int64)[kept])
+                elevations.append(np.frombuffer(s.ele, dtype=np.float64)[kept])
+                heart_rates.append(np.frombuffer(s.hr, dtype=np.int32)[kept])
+        self.geometry = TrackGeometry.from_segments(segments)
+        if segments:
+            time = np.concatenate(times).astype(np.float64)
+            time[time == NO_TIME] = np.nan
+            self.geometry.time = time / 10**6
+            self.geometry.ele = np.concatenate(elevations)
+            self.geometry.hr = np.concatenate(heart_rates)
+            self.average_heartrate = heart_rate_stats(self.geometry.hr)[0]
+        # get start point
+        try:
+            self.start_latlng = start_point(*self.geometry.first_point())
+        except:
+            pass
+        if not self.start_time_local:
+            self.start_time_local, self.end_time_local = parse_datetime_to_local(
+                self.start_time, self.end_time, self.geometry.first_point()
+            )
+        self.polyline_str = self.geometry.encode()
+        self.moving_dict = {
+            "distance": moving_distance,
+            "moving_time": datetime.timedelta(seconds=moving_time),
+            "elapsed_time": datetime.timedelta(seconds=(moving_time + stopped_time)),
+            "average_speed": moving_distance / moving_time if moving_time else 0,
+        }
+
+    def _load_fit_data(self, fit):
+        message = fit.session
+        if message is None:
+            raise TrackLoadError("FIT file has no session.")
         self.start_time = datetime.datetime.utcfromtimestamp(
             (message["start_time"] + FIT_EPOCH_S)
         )
@@ -264,7 +420,9 @@ class Track:
         )
         self.length = message["total_distance"]
         self.average_heartrate = (
-            message["avg_heart_rate"] if "avg_heart_rate" in message else None
+            message["avg_heart_rate"]
+            if "avg_heart_rate" in message
+            else heart_rate_stats(fit.records["heart_rate"])[0]
         )
         self.type = message["sport"].lower()
 
@@ -285,45 +443,63 @@ class Track:
             if message["enhanced_avg_speed"]
             else message["avg_speed"]
         )
-        for record in fit["record_mesgs"]:
-            if "position_lat" in record and "position_long" in record:
-                lat = record["position_lat"] / SEMICIRCLE
-                lng = record["position_long"] / SEMICIRCLE
-                _polylines.append(s2.LatLng.from_degrees(lat, lng))
-                self.polyline_container.append([lat, lng])
-        for record in fit["device_info_mesgs"]:
+        for record in fit.device_infos:
             if "device_index" in record and record["device_index"] == "creator":
                 self.source = f'{record["manufacturer"]} {record["garmin_product"]} fit'
                 break
-        if self.polyline_container:
+        records = fit.records
+        has_position = ~(
+            np.isnan(records["position_lat"]) | np.isnan(records["position_long"])
+        )
+        if has_position.any():
+            self.geometry = TrackGeometry.from_segments(
+                [
+                    (
+                        records["position_lat"][has_position] / SEMICIRCLE,
+                        records["position_long"][has_position] / SEMICIRCLE,
+                    )
+                ]
+            )
+            self.geometry.time = records["timestamp"][has_position] + FIT_EPOCH_S
+            self.geometry.ele = records["altitude"][has_position]
+            heart_rate = records["heart_rate"][has_position]
+            self.geometry.hr = np.nan_to_num(heart_rate, nan=0).astype(np.int32)
             self.start_time_local, self.end_time_local = parse_datetime_to_local(
-                self.start_time, self.end_time, self.polyline_container[0]
+                self.start_time, self.end_time, self.geometry.first_point()
             )
-            self.start_latlng = start_point(*self.polyline_container[0])
-            self.polylines.append(_polylines)
-            self.polyline_str = polyline.encode(self.polyline_container)
+            self.start_latlng = start_point(*self.geometry.first_point())
+            self.polyline_str = self.geometry.encode()
         else:
             self.start_time_local, self.end_time_local = parse_datetime_to_local(
                 self.start_time, self.end_time, None
             )
 
     def append(self, other):
-        """Append other track to self."""
+        """Append other track to self.
+
+        Only other is remembered here, the geometry, polyline and moving data
+        of all appended tracks are combined once when they are used next.
+        """
         self.end_time = other.end_time
         self.length += other.length
+        self._appended.append(other)
+        self.file_names.extend(other.file_names)
+        self.special = self.special or other.special
+
+    def _combine_appended(self):
+        appended, self._appended = self._appended, []
+        self._geometry = self._geometry.concat(*(t.geometry for t in appended))
+        self._polyline_str = None
         # TODO maybe a better way
         try:
-            self.moving_dict["distance"] += other.moving_dict["distance"]
-            self.moving_dict["moving_time"] += other.moving_dict["moving_time"]
-            self.moving_dict["elapsed_time"] += other.moving_dict["elapsed_time"]
-            self.polyline_container.extend(other.polyline_container)
-            self.polyline_str = polyline.encode(self.polyline_container)
-            self.moving_dict["average_speed"] = (
-                self.moving_dict["distance"]
-                / self.moving_dict["moving_time"].total_seconds()
+            for other in appended:
+                self._moving_dict["distance"] += other.moving_dict["distance"]
+                self._moving_dict["moving_time"] += other.moving_dict["moving_time"]
+                self._moving_dict["elapsed_time"] += other.moving_dict["elapsed_time"]
+            self._moving_dict["average_speed"] = (
+                self._moving_dict["distance"]
+                / self._moving_dict["moving_time"].total_seconds()
             )
-            self.file_names.extend(other.file_names)
-            self.special = self.special or other.special
         except:
             print(
                 f"something wrong append this {self.end_time},in files {str(self.file_names)}"
@@ -366,3 +542,66 @@ class Track:
         d.update(self.moving_dict)
         # return a nametuple that can use . to get attr
         return namedtuple("x", d.keys())(*d.values())
+
+    def to_dict(self):
+        """Serialize the extracted track fields, used by the track cache."""
+
+        def _time(t):
+            return t.isoformat() if t else None
+
+        return {
+            "file_names": self.file_names,
+            "segment_sizes": self.geometry.segment_sizes(),
+            "polyline_str": self.polyline_str,
+            "start_time": _time(self.start_time),
+            "end_time": _time(self.end_time),
+            "start_time_local": _time(self.start_time_local),
+            "end_time_local": _time(self.end_time_local),
+            "length": self.length,
+            "average_heartrate": self.average_heartrate,
+            "moving_dict": {
+                k: v.total_seconds() if isinstance(v, datetime.timedelta) else v
+                for k, v in self.moving_dict.items()
+            },
+            "run_id": self.run_id,
+            "start_latlng": list(self.start_latlng) if self.start_latlng else [],
+            "type": self.type,
+            "source": self.source,
+            "name": self.name,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        """Rebuild a track serialized by to_dict."""
+
+        def _time(t):
+            return datetime.datetime.fromisoformat(t) if t else None
+
+        t = cls()
+        t.file_names = d["file_names"]
+        t.polyline_str = d["polyline_str"]
+        t.start_time = _time(d["start_time"])
+        t.end_time = _time(d["end_time"])
+        t.start_time_local = _time(d["start_time_local"])
+        t.end_time_local = _time(d["end_time_local"])
+        t.length = d["length"]
+        t.average_heartrate = d["average_heartrate"]
+        t.moving_dict = {
+            k: (
+                v
+                if k in ("distance", "average_speed")
+                else datetime.timedelta(seconds=v)
+            )
+            for k, v in d["moving_dict"].items()
+        }
+        t.run_id = d["run_id"]
+        t.start_latlng = start_point(*d["start_latlng"]) if d["start_latlng"] else []
+        t.type = d["type"]
+        t.source = d["source"]
+        t.name = d["name"]
+        coords = decode_coords(t.polyline_str or "")
+        if len(coords):
+            t.geometry = TrackGeometry(
+                coords[:, 0], coords[:, 1], np.cumsum([0] + d["segment_sizes"])
+            )
+        return t
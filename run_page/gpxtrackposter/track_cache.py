@@ -0,0 +1,149 @@
+"""Persistent cache of already parsed track files"""
+
+# Copyright 2016-2019 Florian Pigorsch & Contributors. All rights reserved.
+# 2019-now yihong0618 Florian Pigorsch & Contributors. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import hashlib
+import json
+import os
+
+from polyline_simplify import SIMPLIFY_MAX_DISTANCE
+
+from .track import FIT_READER, GPX_READER, GPX_SIMPLIFY_DISTANCE, TCX_READER, Track
+
+# bump this whenever Track.load_gpx/load_tcx/load_fit extract different values,
+# all cached entries written by an older loader are parsed again
+TRACK_CACHE_VERSION = 2
+# the parsers may fill fields differently, entries of other ones are not used
+TRACK_READERS = {"gpx": GPX_READER, "tcx": TCX_READER, "fit": FIT_READER}
+
+
+def file_digest(file_name):
+    h = hashlib.sha1()
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class TrackCache:
+    """Map data files to the track fields extracted from them.
+
+    An entry is valid while the file keeps its size and mtime. When only the
+    mtime changed (e.g. after a fresh git checkout) the content digest decides.
+
+    Attributes:
+        cache_file: JSON file the cache is persisted in.
+        entries: Cached entries keyed by the file path relative to root_dir.
+
+    Methods:
+        get: Return the cached Track of a file or None.
+        put: Store the serialized Track parsed from a file.
+        get_start_time: Return the sniffed start time of a file.
+        put_start_time: Store the sniffed start time of a file.
+        save: Write the cache back to cache_file if it changed.
+    """
+
+    def __init__(self, cache_file, root_dir=None):
+        self.cache_file = cache_file
+        self.root_dir = root_dir or os.path.dirname(os.path.abspath(cache_file))
+        self.entries = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.cache_file):
+            return
+        with open(self.cache_file, "r") as f:
+            try:
+                data = json.load(f)
+            except Exception as e:
+                print(f"json load {self.cache_file} \nerror {e}")
+                return
+        if (
+            data.get("version") != TRACK_CACHE_VERSION
+            # older caches were simplified with gpxpy's default
+            or data.get("simplify_distance", SIMPLIFY_MAX_DISTANCE)
+            != GPX_SIMPLIFY_DISTANCE
+            # written by other parsers, older caches do not name theirs
+            or data.get("readers") != TRACK_READERS
+        ):
+            self.dirty = True
+            return
+        self.entries = data.get("files", {})
+
+    def _key(self, file_name):
+        return os.path.relpath(os.path.abspath(file_name), self.root_dir)
+
+    def _lookup(self, file_name, file_suffix):
+        key = self._key(file_name)
+        entry = self.entries.get(key)
+        if not entry or entry.get("suffix") != file_suffix:
+            return None
+        stat = os.stat(file_name)
+        if entry["size"] != stat.st_size:
+            return None
+        if entry["mtime"] != stat.st_mtime_ns:
+            if entry["sha1"] != file_digest(file_name):
+                return None
+            entry["mtime"] = stat.st_mtime_ns
+            self.dirty = True
+        return entry
+
+    def get(self, file_name, file_suffix="gpx"):
+        entry = self._lookup(file_name, file_suffix)
+        if entry is None or "track" not in entry:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return Track.from_dict(entry["track"])
+
+    def put(self, file_name, track_dict, file_suffix="gpx"):
+        """track_dict: the Track parsed from file_name, serialized by Track.to_dict()"""
+        self._new_entry(file_name, file_suffix)["track"] = track_dict
+
+    def get_start_time(self, file_name, file_suffix="gpx"):
+        """(True, start time or None) if the file was sniffed before, else (False, None)"""
+        entry = self._lookup(file_name, file_suffix)
+        if entry is None or "sniff" not in entry:
+            return False, None
+        start_time = entry["sniff"]["start_time"]
+        return True, datetime.datetime.fromisoformat(start_time) if start_time else None
+
+    def put_start_time(self, file_name, start_time, file_suffix="gpx"):
+        entry = self._lookup(file_name, file_suffix)
+        if entry is None:
+            entry = self._new_entry(file_name, file_suffix)
+        entry["sniff"] = {"start_time": start_time.isoformat() if start_time else None}
+        self.dirty = True
+
+    def _new_entry(self, file_name, file_suffix):
+        stat = os.stat(file_name)
+        entry = self.entries[self._key(file_name)] = {
+            "suffix": file_suffix,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "sha1": file_digest(file_name),
+        }
+        self.dirty = True
+        return entry
+
+    def save(self):
+        if not self.dirty:
+            return
+        with open(self.cache_file, "w") as f:
+            json.dump(
+                {
+                    "version": TRACK_CACHE_VERSION,
+                    "simplify_distance": GPX_SIMPLIFY_DISTANCE,
+                    "readers": TRACK_READERS,
+                    "files": self.entries,
+                },
+                f,
+            )
+        self.dirty = False
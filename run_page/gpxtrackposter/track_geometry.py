@@ -0,0 +1,114 @@
+"""Array backed geometry of a track"""
+
+# Copyright 2016-2019 Florian Pigorsch & Contributors. All rights reserved.
+# 2019-now yihong0618 Florian Pigorsch & Contributors. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import numpy as np
+import s2sphere as s2
+from polyline_codec import encode_coords
+
+
+class TrackGeometry:
+    """Points of all segments of a track in flat float64 columns.
+
+    Attributes:
+        lat: Latitudes in degrees.
+        lon: Longitudes in degrees.
+        offsets: Segment i is lat[offsets[i]:offsets[i + 1]].
+        time, ele, hr: Optional per point columns, None when not loaded.
+
+    Methods:
+        from_segments: Build the geometry from a list of (lat, lon) segments.
+        segments: Iterate over the (lat, lon) arrays of every segment.
+        concat: A new geometry with the segments of others appended.
+        bbox: Smallest s2.LatLngRect containing all points.
+        encode: Google encoded polyline of all points.
+    """
+
+    __slots__ = ("lat", "lon", "offsets", "time", "ele", "hr")
+
+    def __init__(self, lat=None, lon=None, offsets=None):
+        self.lat = np.asarray(lat if lat is not None else [], dtype=np.float64)
+        self.lon = np.asarray(lon if lon is not None else [], dtype=np.float64)
+        if offsets is None:
+            offsets = [0, len(self.lat)] if len(self.lat) else [0]
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.time = None
+        self.ele = None
+        self.hr = None
+
+    @classmethod
+    def from_points(cls, points):
+        """One segment from a list of (lat, lon) pairs."""
+        return cls.from_segments([points])
+
+    @classmethod
+    def from_segments(cls, segments):
+        """segments: list of (lat, lon) pair lists or of (lat_array, lon_array) tuples."""
+        lats, lons, offsets = [], [], [0]
+        for segment in segments:
+            if isinstance(segment, tuple) and len(segment) == 2:
+                lat, lon = (np.asarray(c, dtype=np.float64) for c in segment)
+            else:
+                coords = np.asarray(segment, dtype=np.float64).reshape(-1, 2)
+                lat, lon = coords[:, 0], coords[:, 1]
+            if not len(lat):
+                continue
+            lats.append(lat)
+            lons.append(lon)
+            offsets.append(offsets[-1] + len(lat))
+        if not lats:
+            return cls()
+        return cls(np.concatenate(lats), np.concatenate(lons), offsets)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def segment_count(self):
+        return len(self.offsets) - 1
+
+    def segment_sizes(self):
+        return np.diff(self.offsets).tolist()
+
+    def segments(self):
+        for start, end in zip(self.offsets[:-1], self.offsets[1:]):
+            yield self.lat[start:end], self.lon[start:end]
+
+    def first_point(self):
+        return (float(self.lat[0]), float(self.lon[0])) if len(self.lat) else None
+
+    def concat(self, *others):
+        parts = [g for g in (self, *others) if len(g)]
+        if len(parts) < 2:
+            return parts[0] if parts else self
+        shifts = np.cumsum([0] + [len(g) for g in parts[:-1]])
+        return TrackGeometry(
+            np.concatenate([g.lat for g in parts]),
+            np.concatenate([g.lon for g in parts]),
+            np.concatenate(
+                [parts[0].offsets]
+                + [g.offsets[1:] + shift for g, shift in zip(parts[1:], shifts[1:])]
+            ),
+        )
+
+    def bbox(self):
+        if not len(self.lat):
+            return s2.LatLngRect()
+        lat = np.radians(self.lat)
+        lng = np.radians(self.lon)
+        lo = s2.LatLng.from_radians(lat.min(), lng.min()).normalized()
+        hi = s2.LatLng.from_radians(lat.max(), lng.max()).normalized()
+        if hi.lng().radians - lo.lng().radians <= np.pi:
+            return s2.LatLngRect.from_point_pair(lo, hi)
+        # crossing the antimeridian, let s2 pick the shorter longitude interval
+        bbox = s2.LatLngRect()
+        for a, b in zip(lat.tolist(), lng.tolist()):
+            bbox = bbox.union(
+                s2.LatLngRect.from_point(s2.LatLng.from_radians(a, b).normalized())
+            )
+        return bbox
+
+    def encode(self):
+        return encode_coords(self.lat, self.lon)
@@ -6,23 +6,41 @@
 # Use of this source code is governed by a MIT-style
 # license that can be found in the LICENSE file.
 
+import collections
+import datetime
 import logging
 import os
 import sys
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 
-from generator.db import Activity, init_db
+from config import TRACK_CACHE_FILE, TRACK_QUARANTINE_FILE
+from generator.db import Activity, ActivityPolyline, filter_out_cache, init_db
+from generator.polyline_levels import update_polyline_levels
+from polyline_codec import decode_many
+from sqlalchemy import func
+from sqlalchemy.orm import selectinload
 
-from .exceptions import ParameterError, TrackLoadError
+from .exceptions import ParameterError
+from .fit_reader import sniff_start_time as sniff_fit_start_time
+from .gpx_reader import sniff_start_time as sniff_gpx_start_time
+from .tcx_reader import sniff_start_time as sniff_tcx_start_time
 from .track import Track
+from .track_cache import TrackCache
+from .track_geometry import TrackGeometry
+from .track_quarantine import TrackQuarantine
 from .year_range import YearRange
 
 from synced_data_file_logger import load_synced_file_list
 
 log = logging.getLogger(__name__)
 
+# a sniffed start time is UTC and may be a bit before the first track point,
+# files are only skipped when they are outside year_range by more than this
+SNIFF_MARGIN = datetime.timedelta(days=2)
+
 
 def load_gpx_file(file_name):
     """Load an individual GPX file as a track by using Track.load_gpx()"""
@@ -45,55 +63,173 @@ def load_fit_file(file_name):
     return t
 
 
+def load_file_chunk(load_func, file_names):
+    """Load a chunk of files in a worker, tracks are sent back serialized by Track.to_dict()
+
+    Returns (file name, track dict, load error) for every file.
+    """
+    result = []
+    for file_name in file_names:
+        t = load_func(file_name)
+        result.append((file_name, t.to_dict(), t.load_error))
+    return result
+
+
 class TrackLoader:
     """
     Attributes:
         min_length: All tracks shorter than this value are filtered out.
         special_file_names: Tracks marked as special in command line args
         year_range: All tracks outside of this range will be filtered out.
+        cache_file: Parsed tracks are cached here, None disables the cache.
+        quarantine_file: Files that failed to load are recorded here and
+            skipped while they do not change, None disables the quarantine.
+        workers: Number of parsing processes, None means one per CPU.
+        chunk_size: Number of files a worker parses per task.
+        max_in_flight: Max number of chunks submitted but not collected yet,
+            None means two per worker.
+        sniff_func_dict: Per file suffix, a function that cheaply reads the
+            start time of a file, used to skip files outside year_range
+            without parsing them.
 
     Methods:
         load_tracks: Load all data from GPX files
+        iter_tracks: Yield the filtered tracks one by one while they are parsed
     """
 
     def __init__(self):
         self.min_length = 100
         self.special_file_names = []
         self.year_range = YearRange()
+        self.cache_file = TRACK_CACHE_FILE
+        self.quarantine_file = TRACK_QUARANTINE_FILE
+        self.workers = None
+        self.chunk_size = 8
+        self.max_in_flight = None
         self.load_func_dict = {
             "gpx": load_gpx_file,
             "tcx": load_tcx_file,
             "fit": load_fit_file,
         }
+        self.sniff_func_dict = {
+            "gpx": sniff_gpx_start_time,
+            "tcx": sniff_tcx_start_time,
+            "fit": sniff_fit_start_time,
+        }
 
     def load_tracks(self, data_dir, file_suffix="gpx", merge_tracks=True):
         """Load tracks data_dir and return as a List of tracks"""
+        tracks = list(self.iter_tracks(data_dir, file_suffix))
+
+        # merge tracks that took place within one hour when requested
+        if merge_tracks:
+            tracks = self._merge_tracks(tracks)
+        # filter out tracks with length < min_length
+        return [t for t in tracks if t.length >= self.min_length]
+
+    def iter_tracks(self, data_dir, file_suffix="gpx"):
+        """Yield the tracks of data_dir that pass _filter_tracks as soon as they are loaded
+
+        Neither merged nor filtered by min_length, the caller decides.
+        """
         file_names = [x for x in self._list_data_files(data_dir, file_suffix)]
         print(f"{file_suffix.upper()} files: {len(file_names)}")
 
-        tracks = []
-
-        loaded_tracks = self._load_data_tracks(
-            file_names, self.load_func_dict.get(file_suffix, load_gpx_file)
+        cache = TrackCache(self.cache_file) if self.cache_file else None
+        quarantine = (
+            TrackQuarantine(self.quarantine_file) if self.quarantine_file else None
         )
+        try:
+            if cache:
+                new_file_names = []
+                for file_name in file_names:
+                    t = cache.get(file_name, file_suffix)
+                    if t is None:
+                        new_file_names.append(file_name)
+                    else:
+                        yield from self._filter_tracks([t])
+                log.info(f"Tracks loaded from cache: {cache.hits}")
+                file_names = new_file_names
+            if quarantine:
+                count = len(file_names)
+                file_names = [
+                    f for f in file_names if not quarantine.contains(f, file_suffix)
+                ]
+                log.info(f"Quarantined files skipped: {count - len(file_names)}")
+            file_names = self._prefilter_year_range(file_names, file_suffix, cache)
 
-        tracks.extend(loaded_tracks.values())
-        log.info(f"Conventionally loaded tracks: {len(loaded_tracks)}")
+            loaded_count = 0
+            for file_name, track_dict, load_error in self._iter_data_tracks(
+                file_names, self.load_func_dict.get(file_suffix, load_gpx_file)
+            ):
+                loaded_count += 1
+                if load_error:
+                    # failed loads are not cached, they stay quarantined until the file changes
+                    if quarantine:
+                        quarantine.add(file_name, load_error, file_suffix)
+                    continue
+                if quarantine:
+                    quarantine.release(file_name)
+                if cache and track_dict["start_time"]:
+                    cache.put(file_name, track_dict, file_suffix)
+                yield from self._filter_tracks([Track.from_dict(track_dict)])
+            log.info(f"Conventionally loaded tracks: {loaded_count}")
+        finally:
+            if cache:
+                cache.save()
+            if quarantine:
+                quarantine.save()
 
-        tracks = self._filter_tracks(tracks)
+    def _prefilter_year_range(self, file_names, file_suffix, cache=None):
+        """Drop the files whose sniffed start time is clearly outside year_range
 
-        # merge tracks that took place within one hour when requested
-        if merge_tracks:
-            tracks = self._merge_tracks(tracks)
-        # filter out tracks with length < min_length
-        return [t for t in tracks if t.length >= self.min_length]
+        Files that can not be sniffed are kept, _filter_tracks decides on them.
+        """
+        sniff_func = self.sniff_func_dict.get(file_suffix)
+        if self.year_range.from_year is None or sniff_func is None:
+            return file_names
+        kept_file_names = []
+        for file_name in file_names:
+            sniffed, start_time = (
+                cache.get_start_time(file_name, file_suffix) if cache else (False, None)
+            )
+            if not sniffed:
+                try:
+                    start_time = sniff_func(file_name)
+                except Exception as e:
+                    log.info(f"{file_name}: can not sniff start time: {e}")
+                    start_time = None
+                if start_time and start_time.tzinfo:
+                    start_time = start_time.astimezone(datetime.timezone.utc).replace(
+                        tzinfo=None
+                    )
+                if cache:
+                    cache.put_start_time(file_name, start_time, file_suffix)
+            if (
+                start_time is None
+                or self.year_range.contains(start_time - SNIFF_MARGIN)
+                or self.year_range.contains(start_time + SNIFF_MARGIN)
+            ):
+                kept_file_names.append(file_name)
+            else:
+                log.info(
+                    f"{file_name}: skipping file with wrong year {start_time.year}"
+                )
+        log.info(
+            f"Files skipped by start time: {len(file_names) - len(kept_file_names)}"
+        )
+        return kept_file_names
 
-    def load_tracks_from_db(self, sql_file, is_grid=False, is_circular=False):
+    def load_tracks_from_db(self, sql_file, is_grid=False, is_circular=False, level=0):
+        """Tracks of the saved activities, with the polylines of level when given."""
         session = init_db(sql_file)
         if is_grid:
             activities = (
                 session.query(Activity)
-                .filter(Activity.summary_polyline != "")
+                # empty polylines have a row too, with an empty blob
+                .filter(
+                    Activity.polyline.has(func.length(ActivityPolyline.polyline) > 0)
+                )
                 .filter(Activity.type.not_in(["Flight"]))
                 .order_by(Activity.start_date_local)
             )
@@ -109,11 +245,32 @@ class TrackLoader:
                 .filter(Activity.type.not_in(["Flight"]))
                 .order_by(Activity.start_date_local)
             )
+        activities = activities.options(selectinload(Activity.polyline))
+        if level:
+            # data.db is written only when the levels or the filter cache change
+            if update_polyline_levels(session):
+                session.commit()
+            activities = activities.options(
+                selectinload(Activity.levels.and_(ActivityPolyline.level == level))
+            )
+        activities = activities.all()
+        # decode the polylines of all activities at once
+        coords, offsets = decode_many(
+            Track.polyline_from_db(
+                activity, lambda p: filter_out_cache.filter_out(session, p), level
+            )
+            or ""
+            for activity in activities
+        )
         tracks = []
-        for activity in activities:
+        for activity, start, end in zip(activities, offsets[:-1], offsets[1:]):
             t = Track()
-            t.load_from_db(activity)
+            t.load_from_db(
+                activity, geometry=TrackGeometry.from_points(coords[start:end])
+            )
             tracks.append(t)
+        if filter_out_cache.save(session):
+            session.commit()
         print(f"All tracks: {len(tracks)}")
         tracks = self._filter_tracks(tracks)
         print(f"After filter tracks: {len(tracks)}")
@@ -157,26 +314,77 @@ class TrackLoader:
         log.info(f"Merged {len(tracks) - len(merged_tracks)} track(s)")
         return merged_tracks
 
+    def _iter_data_tracks(self, file_names, load_func=load_gpx_file):
+        """Parse file_names in a process pool, yield (file_name, track dict) as chunks finish
+
+        At most max_in_flight chunks are pending at any time, so memory does not
+        grow with the number of files. The files of a chunk that fails as a whole
+        are parsed again one at a time, and a pool broken by a crashing worker
+        is replaced by a new one.
+        """
+        if not file_names:
+            return
+        chunks = collections.deque(
+            file_names[i : i + self.chunk_size]
+            for i in range(0, len(file_names), self.chunk_size)
+        )
+        retries = collections.deque()
+        workers = self.workers or os.cpu_count() or 1
+        max_in_flight = self.max_in_flight or 2 * workers
+        while chunks or retries:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers
+            ) as executor:
+                future_to_chunk = {}
+                while self._submit_chunks(
+                    executor, load_func, chunks, retries, future_to_chunk, max_in_flight
+                ):
+                    yield from self._collect_chunks(future_to_chunk, retries)
+
     @staticmethod
-    def _load_data_tracks(file_names, load_func=load_gpx_file):
+    def _submit_chunks(
+        executor, load_func, chunks, retries, future_to_chunk, max_in_flight
+    ):
+        """Submit chunks until max_in_flight are pending, False when none is
+
+        A retried file is only submitted when nothing else is pending, a file
+        that crashes its worker must not take other files down with it.
         """
-        TODO refactor with _load_tcx_tracks
+        while True:
+            queue = retries if retries else chunks
+            if not queue or len(future_to_chunk) >= max_in_flight:
+                break
+            if queue is retries and future_to_chunk:
+                break
+            chunk = queue.popleft()
+            try:
+                future = executor.submit(load_file_chunk, load_func, chunk)
+            except BrokenProcessPool:
+                queue.appendleft(chunk)
+                break
+            future_to_chunk[future] = (chunk, queue is retries)
+        return bool(future_to_chunk)
+
+    @staticmethod
+    def _collect_chunks(future_to_chunk, retries):
+        """Wait for at least one pending chunk and yield its tracks
+
+        The files of a failed chunk are queued in retries one by one, a file
+        that fails on its own is left out.
         """
-        tracks = {}
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            future_to_file_name = {
-                executor.submit(load_func, file_name): file_name
-                for file_name in file_names
-            }
-        for future in concurrent.futures.as_completed(future_to_file_name):
-            file_name = future_to_file_name[future]
+        done, _ = concurrent.futures.wait(
+            future_to_chunk, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in done:
+            chunk, retried = future_to_chunk.pop(future)
             try:
-                t = future.result()
-            except TrackLoadError as e:
-                log.error(f"Error while loading {file_name}: {e}")
+                result = future.result()
+            except Exception as e:
+                log.error(f"Error while loading {', '.join(chunk)}: {e}")
+                if not retried:
+                    retries.extend([file_name] for file_name in chunk)
             else:
-                tracks[file_name] = t
-        return tracks
+                yield from result
 
     @staticmethod
     def _list_data_files(data_dir, file_suffix):
@@ -0,0 +1,89 @@
+"""Persistent index of data files that failed to load"""
+
+# Copyright 2016-2019 Florian Pigorsch & Contributors. All rights reserved.
+# 2019-now yihong0618 Florian Pigorsch & Contributors. All rights reserved.
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import json
+import os
+
+from .track_cache import file_digest
+
+
+class TrackQuarantine:
+    """Remember files that failed to load, keyed by path, size and mtime.
+
+    A quarantined file is skipped until it changes on disk or is released.
+    When only the mtime changed (e.g. after a fresh git checkout) the content
+    digest decides, as in TrackCache.
+
+    Attributes:
+        quarantine_file: JSON file the index is persisted in.
+        entries: (suffix, size, mtime, sha1, error) of every failed file, keyed by
+            the file path relative to root_dir.
+
+    Methods:
+        contains: If a file failed before and did not change since.
+        add: Record the error a file failed with.
+        release: Forget a file, or all files when none is given.
+        save: Write the index back to quarantine_file if it changed.
+    """
+
+    def __init__(self, quarantine_file, root_dir=None):
+        self.quarantine_file = quarantine_file
+        self.root_dir = root_dir or os.path.dirname(os.path.abspath(quarantine_file))
+        self.entries = {}
+        self.dirty = False
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.quarantine_file):
+            return
+        with open(self.quarantine_file, "r") as f:
+            try:
+                self.entries = json.load(f)
+            except Exception as e:
+                print(f"json load {self.quarantine_file} \nerror {e}")
+
+    def _key(self, file_name):
+        return os.path.relpath(os.path.abspath(file_name), self.root_dir)
+
+    def contains(self, file_name, file_suffix="gpx"):
+        entry = self.entries.get(self._key(file_name))
+        if not entry or entry["suffix"] != file_suffix:
+            return False
+        stat = os.stat(file_name)
+        if entry["size"] != stat.st_size:
+            return False
+        if entry["mtime"] != stat.st_mtime_ns:
+            if entry.get("sha1") != file_digest(file_name):
+                return False
+            entry["mtime"] = stat.st_mtime_ns
+            self.dirty = True
+        return True
+
+    def add(self, file_name, error, file_suffix="gpx"):
+        stat = os.stat(file_name)
+        self.entries[self._key(file_name)] = {
+            "suffix": file_suffix,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "sha1": file_digest(file_name),
+            "error": error,
+        }
+        self.dirty = True
+
+    def release(self, file_name=None):
+        if file_name is None:
+            self.dirty = self.dirty or bool(self.entries)
+            self.entries = {}
+        elif self.entries.pop(self._key(file_name), None) is not None:
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        with open(self.quarantine_file, "w") as f:
+            json.dump(self.entries, f, indent=2)
+        self.dirty = False
@@ -11,6 +11,7 @@ from datetime import datetime
 from typing import List, Optional, Tuple
 
 import colour
+import numpy as np
 import pytz
 import s2sphere as s2
 
@@ -42,7 +43,7 @@ def lat2y(lat_deg: float) -> float:
 
 
 def project(
-    bbox: s2.LatLngRect, size: XY, offset: XY, latlnglines: List[List[s2.LatLng]]
+    bbox: s2.LatLngRect, size: XY, offset: XY, geometry: "TrackGeometry"
 ) -> List[List[Tuple[float, float]]]:
     min_x = lng2x(bbox.lng_lo().degrees)
     d_x = lng2x(bbox.lng_hi().degrees) - min_x
@@ -61,22 +62,34 @@ def project(
     lines = []
     # If len > $zoom_threshold, choose 1 point out of every $step to reduce size of the SVG file
     zoom_threshold = 400
-    for latlngline in latlnglines:
-        line = []
-        step = int(len(latlngline) / zoom_threshold) + 1
-        for i in range(0, len(latlngline), step):
-            latlng = latlngline[i]
-            if bbox.contains(latlng):
-                line.append((offset + scale * latlng2xy(latlng)).tuple())
-            else:
-                if len(line) > 0:
-                    lines.append(line)
-                    line = []
-        if len(line) > 0:
-            lines.append(line)
+    for lat, lng in geometry.segments():
+        step = int(len(lat) / zoom_threshold) + 1
+        lat, lng = lat[::step], lng[::step]
+        inside = _bbox_contains(bbox, np.radians(lat), np.radians(lng))
+        xs = (offset.x + scale * (lng / 180 + 1)).tolist()
+        ys = (
+            offset.y
+            + scale * (0.5 - np.log(np.tan(np.pi / 4 * (1 + lat / 90))) / np.pi)
+        ).tolist()
+        # split the line wherever it leaves the bbox
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], inside, [0]))))
+        for start, end in zip(edges[::2], edges[1::2]):
+            lines.append(list(zip(xs[start:end], ys[start:end])))
     return lines
 
 
+def _bbox_contains(bbox: s2.LatLngRect, lat: np.ndarray, lng: np.ndarray) -> np.ndarray:
+    """Vectorized s2.LatLngRect.contains() for points given in radians."""
+    inside = (lat >= bbox.lat_lo().radians) & (lat <= bbox.lat_hi().radians)
+    lng_lo, lng_hi = bbox.lng_lo().radians, bbox.lng_hi().radians
+    if lng_lo <= lng_hi:
+        inside &= (lng >= lng_lo) & (lng <= lng_hi)
+    else:
+        # the interval wraps around the antimeridian
+        inside &= (lng >= lng_lo) | (lng <= lng_hi)
+    return inside.astype(np.int8)
+
+
 def compute_bounds_xy(lines: List[List[XY]]) -> Tuple[ValueRange, ValueRange]:
     range_x = ValueRange()
     range_y = ValueRange()
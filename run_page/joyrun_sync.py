@@ -1,6 +1,5 @@
 # some code from https://github.com/fieryd/PKURunningHelper great thanks
 import argparse
-import json
 import os
 import time
 from collections import namedtuple
@@ -13,6 +12,7 @@ import polyline
 import requests
 from config import BASE_TIMEZONE, GPX_FOLDER, JSON_FILE, SQL_FILE, run_map, start_point
 from generator import Generator
+from track_metrics import heart_rate_stats
 
 from utils import adjust_time
 
@@ -280,10 +280,9 @@ class Joyrun:
             print(f"Heart Rate: can not eval for {str(heart_rate_list)}")
         heart_rate = None
         if heart_rate_list:
-            heart_rate = int(sum(heart_rate_list) / len(heart_rate_list))
-            # fix #66
-            if heart_rate < 0:
-                heart_rate = None
+            # fix #66, negative heart rates are dropped
+            heart_rate = heart_rate_stats(heart_rate_list)[0]
+            heart_rate = int(heart_rate) if heart_rate else None
 
         polyline_str = polyline.encode(run_points_data) if run_points_data else ""
         start_latlng = start_point(*run_points_data[0]) if run_points_data else None
@@ -324,11 +323,10 @@ class Joyrun:
 
     def get_all_joyrun_tracks(self, old_tracks_ids, with_gpx=False):
         run_ids = self.get_runs_records_ids()
-        old_tracks_ids = [int(i) for i in old_tracks_ids if i.isdigit()]
 
         old_gpx_ids = os.listdir(GPX_FOLDER)
         old_gpx_ids = [i.split(".")[0] for i in old_gpx_ids if not i.startswith(".")]
-        new_run_ids = list(set(run_ids) - set(old_tracks_ids))
+        new_run_ids = list(set(run_ids) - old_tracks_ids)
         tracks = []
         for i in new_run_ids:
             run_data = self.get_single_run_record(i)
@@ -369,9 +367,7 @@ if __name__ == "__main__":
         j.login_by_phone()
 
     generator = Generator(SQL_FILE)
-    old_tracks_ids = generator.get_old_tracks_ids()
+    old_tracks_ids = generator.known_run_ids()
     tracks = j.get_all_joyrun_tracks(old_tracks_ids, options.with_gpx)
     generator.sync_from_app(tracks)
-    activities_list = generator.load()
-    with open(JSON_FILE, "w") as f:
-        json.dump(activities_list, f, indent=0)
+    generator.write_activities_file(JSON_FILE)
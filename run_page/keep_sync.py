@@ -14,6 +14,7 @@ import requests
 from config import KEEP_GPX_FOLDER, JSON_FILE, SQL_FILE, run_map, start_point
 from Crypto.Cipher import AES
 from generator import Generator
+from track_metrics import elevation_gain_loss, heart_rate_stats
 from utils import adjust_time
 import xml.etree.ElementTree as ET
 
@@ -155,6 +156,10 @@ def parse_raw_data_to_nametuple(
         # fix #66
         if avg_heart_rate and avg_heart_rate < 0:
             avg_heart_rate = None
+        if not avg_heart_rate and decoded_hr_data:
+            avg_heart_rate = heart_rate_stats(
+                [hr.get("beatsPerMinute") for hr in decoded_hr_data]
+            )[0]
     if run_data["region"]:
       location_dict = run_data["region"]
       address_levels = [
@@ -200,7 +205,9 @@ def parse_raw_data_to_nametuple(
             gpx_data = parse_points_to_gpx(
                 run_points_data_gpx, start_time, KEEP2STRAVA[run_data["dataType"]]
             )
-            elevation_gain = gpx_data.get_uphill_downhill().uphill
+            elevation_gain = elevation_gain_loss(
+                [p.get("altitude") for p in run_points_data_gpx]
+            )[0]
             if with_download_gpx and str(keep_id) not in old_gpx_ids:
                 download_keep_gpx(gpx_data.to_xml(), str(keep_id))
     else:
@@ -404,9 +411,7 @@ def run_keep_sync(email, password, keep_sports_data_api, with_download_gpx=False
     )
     generator.sync_from_app(new_tracks)
 
-    activities_list = generator.load()
-    with open(JSON_FILE, "w") as f:
-        json.dump(activities_list, f)
+    generator.write_activities_file(JSON_FILE, indent=None)
 
 
 if __name__ == "__main__":
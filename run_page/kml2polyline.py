@@ -1,4 +1,3 @@
-import json
 from datetime import datetime, timedelta
 
 import eviltransform
@@ -82,6 +81,4 @@ if __name__ == "__main__":
     # save
     generator = Generator(SQL_FILE)
     generator.sync_from_kml_track(track)
-    activities_list = generator.loadForMapping()
-    with open(JSON_FILE, "w") as json_file:
-        json.dump(activities_list, json_file, indent=0)
+    generator.write_activities_file(JSON_FILE, for_mapping=True)
@@ -19,6 +19,7 @@ from config import (
     run_map,
 )
 from generator import Generator
+from track_metrics import heart_rate_stats
 
 from utils import adjust_time, make_activities_file
 
@@ -344,6 +345,13 @@ def parse_no_gpx_data(activity):
             distance = s.get("value", 0) * 1000
         if s.get("metric") == "heart_rate":
             average_heartrate = s.get("value", None)
+    if average_heartrate is None:
+        for metric in activity["metrics"]:
+            if metric["type"] == "heart_rate":
+                average_heartrate = heart_rate_stats(
+                    [v["value"] for v in metric["values"]]
+                )[0]
+                break
     # maybe training that no distance
     if not distance:
         return
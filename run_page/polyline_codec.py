@@ -0,0 +1,125 @@
+"""
+Google encoded polyline format on NumPy coordinate arrays.
+Byte compatible with the polyline package, including its python 2 rounding.
+"""
+
+import numpy as np
+
+
+def _round(values):
+    # the polyline algorithm uses Python 2's way of rounding (half away from zero)
+    return np.copysign(np.floor(np.abs(values) + 0.5), values).astype(np.int64)
+
+
+def _zigzag_bytes(delta):
+    """Encoded bytes of zigzag values and the cumulative byte count after each."""
+    # number of 5 bit chunks of every value, at least one
+    chunks = np.ones(len(delta), dtype=np.int64)
+    rest = delta >> 5
+    while rest.any():
+        chunks += rest > 0
+        rest >>= 5
+    ends = np.cumsum(chunks)
+    starts = ends - chunks
+    out = np.empty(ends[-1] if len(ends) else 0, dtype=np.uint8)
+    for k in range(int(chunks.max(initial=0))):
+        has_chunk = chunks > k
+        chunk = (delta[has_chunk] >> (5 * k)) & 0x1F
+        # every chunk but the last one of a value carries the continuation bit
+        chunk |= np.where(chunks[has_chunk] > k + 1, 0x20, 0)
+        out[starts[has_chunk] + k] = chunk + 63
+    return out, ends
+
+
+def encode_many(coords, offsets, precision=5):
+    """Encode many polylines at once, polyline i is coords[offsets[i]:offsets[i + 1]].
+
+    Args:
+        coords: (n, 2) array of (lat, lon) points of all polylines.
+        offsets: Start of every polyline in coords, followed by n.
+
+    Returns:
+        A list of the encoded polylines, "" for an empty one.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    values = _round(coords * 10**precision)
+    delta = np.diff(values, axis=0, prepend=0)
+    # the first point of every polyline is encoded as is
+    firsts = offsets[:-1][offsets[:-1] < offsets[1:]]
+    delta[firsts] = values[firsts]
+    delta = delta.ravel() << 1
+    delta = np.where(delta < 0, ~delta, delta)
+    out, ends = _zigzag_bytes(delta)
+    text = out.tobytes().decode("ascii")
+    # two values a point
+    bounds = np.concatenate(([0], ends))[2 * offsets].tolist()
+    return [text[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def encode_coords(lat, lon, precision=5):
+    """Encode lat/lon arrays the same way polyline.encode(list(zip(lat, lon))) does."""
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    return encode_many(np.column_stack((lat, lon)), [0, len(lat)], precision)[0]
+
+
+def decode_many(polyline_strs, precision=5):
+    """Decode many polylines at once, the same points polyline.decode() has.
+
+    Returns:
+        (coords, offsets): (n, 2) array of the (lat, lon) points of all
+        polylines, polyline i is coords[offsets[i]:offsets[i + 1]].
+
+    Raises:
+        ValueError: A polyline is cut off or has a character below "?".
+    """
+    polyline_strs = list(polyline_strs)
+    data = np.frombuffer("".join(polyline_strs).encode("ascii"), dtype=np.uint8)
+    data = data.astype(np.int64) - 63
+    if (data < 0).any():
+        raise ValueError("invalid polyline character")
+    # the last chunk of every value has no continuation bit
+    last = data < 0x20
+    ends = np.flatnonzero(last)
+    lengths = np.array([len(s) for s in polyline_strs], dtype=np.int64)
+    string_ends = np.cumsum(lengths)
+    value_offsets = np.concatenate(([0], np.searchsorted(ends, string_ends)))
+    if (value_offsets % 2).any() or not last[string_ends[lengths > 0] - 1].all():
+        raise ValueError("incomplete polyline")
+
+    sizes = np.diff(ends, prepend=-1)
+    starts = ends - sizes + 1
+    shift = np.arange(len(data)) - np.repeat(starts, sizes)
+    chunks = (data & 0x1F) << (5 * shift)
+    values = np.add.reduceat(chunks, starts) if len(starts) else chunks[:0]
+    values = np.where(values & 1, ~(values >> 1), values >> 1).reshape(-1, 2)
+
+    offsets = value_offsets // 2
+    # points are deltas to the one before, within their own polyline only
+    totals = np.cumsum(values, axis=0)
+    bases = np.concatenate((np.zeros((1, 2), dtype=np.int64), totals))[offsets[:-1]]
+    totals -= np.repeat(bases, np.diff(offsets), axis=0)
+    return totals / float(10**precision), offsets
+
+
+def decode_coords(polyline_str, precision=5):
+    """(n, 2) array of the (lat, lon) points of one polyline."""
+    return decode_many([polyline_str], precision)[0]
+
+
+def first_point(polyline_str, precision=5):
+    """(lat, lon) of the first point of an encoded polyline, None when it is empty."""
+    values = []
+    shift = result = 0
+    for c in polyline_str:
+        byte = ord(c) - 63
+        result |= (byte & 0x1F) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(result >> 1) if result & 1 else result >> 1)
+            if len(values) == 2:
+                factor = 10**precision
+                return values[0] / factor, values[1] / factor
+            shift = result = 0
+    return None
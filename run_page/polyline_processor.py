@@ -1,7 +1,12 @@
+import hashlib
+import json
+import math
 from typing import List, Tuple
 import polyline
 import os
+import numpy as np
 from haversine import haversine
+from polyline_codec import decode_coords, encode_coords
 
 try:
     IGNORE_POLYLINE = (
@@ -20,6 +25,23 @@ except ValueError:
     print("IGNORE_RANGE or IGNORE_START_END_RANGE is not a number")
     exit(1)
 
+# bump when filter_out() changes its results, so memoized ones are not reused
+FILTER_OUT_VERSION = 1
+# the earth radius haversine() uses, in km
+EARTH_RADIUS = 6371.0088
+# NumPy may round a distance differently than haversine() does, distances this
+# close to a limit are measured again with haversine() so the result is the same
+TIE_MARGIN = 1e-9  # km
+
+
+def haversine_np(lat1, lng1, lat2, lng2) -> np.ndarray:
+    """haversine() in km of arrays of degrees, broadcast against each other."""
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    lat = lat2 - lat1
+    lng = lng2 - lng1
+    d = np.sin(lat * 0.5) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(lng * 0.5) ** 2
+    return EARTH_RADIUS * (2 * np.arcsin(np.sqrt(d)))
+
 
 def point_distance_in_range(
     point: Tuple[float], center_point: Tuple[float], distance: int
@@ -33,17 +55,109 @@ def point_in_list_points_range(
     return any([point_distance_in_range(point, p, distance) for p in points])
 
 
+class PointIndex:
+    """Grid of points to find the ones closer than distance km to many others.
+
+    A cell is at least distance wide, so a point can only be in range of the
+    points in its own cell and the eight around it.
+    """
+
+    def __init__(self, points: List[Tuple[float]], distance: float):
+        self.distance = distance
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        # a bit wider than needed, rounding must not move a point out of reach
+        degrees = math.degrees(distance / EARTH_RADIUS) * (1 + 1e-6)
+        self.rows = max(1, math.floor(180 / degrees)) if degrees else 1
+        # a longitude difference in range is widest at the highest latitude
+        top = min(90.0, np.abs(self.points[:, 0]).max(initial=0) + degrees)
+        cos_top = math.cos(math.radians(top))
+        half = math.sin(distance / EARTH_RADIUS / 2)
+        if degrees and cos_top > half:
+            lng_degrees = math.degrees(2 * math.asin(half / cos_top)) * (1 + 1e-6)
+            self.columns = max(1, math.floor(360 / lng_degrees))
+        else:
+            self.columns = 1
+        self.cells = {}
+        for i, cell in enumerate(zip(*self._cells(self.points))):
+            self.cells.setdefault(cell, []).append(i)
+
+    def _cells(self, points):
+        rows = np.floor((points[:, 0] + 90) / 180 * self.rows).astype(np.int64)
+        columns = np.floor((points[:, 1] + 180) / 360 * self.columns).astype(np.int64)
+        return np.clip(rows, 0, self.rows - 1), columns % self.columns
+
+    def _nearby(self, row, column):
+        nearby = []
+        for i in (row - 1, row, row + 1):
+            for j in {(column - 1) % self.columns, column, (column + 1) % self.columns}:
+                nearby.extend(self.cells.get((i, j), ()))
+        return nearby
+
+    def in_range(self, points: np.ndarray) -> np.ndarray:
+        """Mask of the points closer than distance to any indexed point."""
+        mask = np.zeros(len(points), dtype=bool)
+        if not len(points) or not len(self.points):
+            return mask
+        rows, columns = self._cells(points)
+        cell_keys = rows * self.columns + columns
+        for key in np.unique(cell_keys):
+            nearby = self._nearby(*divmod(int(key), self.columns))
+            if not nearby:
+                continue
+            selected = np.flatnonzero(cell_keys == key)
+            lat, lng = points[selected, 0:1], points[selected, 1:2]
+            near = self.points[nearby]
+            d = haversine_np(lat, lng, near[:, 0], near[:, 1])
+            ties = np.abs(d - self.distance) <= TIE_MARGIN
+            close = (d < self.distance) & ~ties
+            for i, j in zip(*np.nonzero(ties)):
+                close[i, j] = point_distance_in_range(
+                    tuple(points[selected[i]]), tuple(near[j]), self.distance
+                )
+            mask[selected] = close.any(axis=1)
+        return mask
+
+
+# PointIndex of the last points passed to range_hiding()
+_point_index = None
+
+
+def _range_hidden(
+    coords: np.ndarray, points: List[Tuple[float]], distance: int
+) -> np.ndarray:
+    """Mask of the coords range_hiding() leaves out."""
+    global _point_index
+    if (
+        _point_index is None
+        or _point_index[0] is not points
+        or _point_index[1] != distance
+    ):
+        _point_index = (points, distance, PointIndex(points, distance))
+    return _point_index[2].in_range(coords)
+
+
 def range_hiding(
     polyline: List[Tuple[float]], points: List[Tuple[float]], distance: int
 ) -> List[Tuple[float]]:
-    return [
-        point
-        for point in polyline
-        if not point_in_list_points_range(point, points, distance)
-    ]
+    if not polyline or not points:
+        return list(polyline)
+    hidden = _range_hidden(np.asarray(polyline, dtype=np.float64), points, distance)
+    return [point for point, hide in zip(polyline, hidden) if not hide]
 
 
-def start_end_hiding(polyline: List[Tuple[float]], distance: int) -> List[Tuple[float]]:
+def _first_beyond(cumulative: np.ndarray, distance: float):
+    """Index of the first sum above distance, None when too close to tell."""
+    i = int(np.searchsorted(cumulative, distance, side="right"))
+    if i < len(cumulative) and cumulative[i] - distance <= TIE_MARGIN:
+        return None
+    if i > 0 and distance - cumulative[i - 1] <= TIE_MARGIN:
+        return None
+    return i
+
+
+def _start_end_hiding(
+    polyline: List[Tuple[float]], distance: int
+) -> List[Tuple[float]]:
     start_index, end_index = 0, len(polyline) - 1
 
     starting_distance = 0
@@ -66,16 +180,43 @@ def start_end_hiding(polyline: List[Tuple[float]], distance: int) -> List[Tuple[
     return polyline[start_index : end_index + 1]
 
 
+def start_end_hiding(polyline: List[Tuple[float]], distance: int) -> List[Tuple[float]]:
+    points = np.asarray(polyline, dtype=np.float64).reshape(-1, 2)
+    steps = haversine_np(points[1:, 0], points[1:, 1], points[:-1, 0], points[:-1, 1])
+    start = _first_beyond(np.cumsum(steps), distance)
+    end = _first_beyond(np.cumsum(steps[::-1]), distance)
+    if start is None or end is None:
+        # a sum too close to distance, add up with haversine() as it always did
+        return _start_end_hiding(polyline, distance)
+    start_index = start + 1 if start < len(steps) else 0
+    end_index = len(steps) - 1 - end if end < len(steps) else len(polyline) - 1
+
+    if start_index >= end_index:
+        return []
+
+    return polyline[start_index : end_index + 1]
+
+
 def filter_out(polyline_str):
     if not polyline_str:
         return
-    pl = polyline.decode(polyline_str)
-    if not pl:
+    pl = decode_coords(polyline_str)
+    if not len(pl):
         return polyline_str
 
+    # both hidings keep the points as they are, so arrays of them do as well
     new_pl = start_end_hiding(pl, IGNORE_START_END_RANGE)
-    new_pl = range_hiding(new_pl, IGNORE_POLYLINE, IGNORE_RANGE)
+    if len(new_pl) and IGNORE_POLYLINE:
+        new_pl = new_pl[~_range_hidden(new_pl, IGNORE_POLYLINE, IGNORE_RANGE)]
 
-    if not new_pl:
+    if not len(new_pl):
         return
-    return polyline.encode(new_pl)
+    return encode_coords(new_pl[:, 0], new_pl[:, 1])
+
+
+def settings_digest() -> str:
+    """sha1 of the privacy settings filter_out() uses, without revealing them."""
+    settings = json.dumps(
+        [FILTER_OUT_VERSION, IGNORE_POLYLINE, IGNORE_RANGE, IGNORE_START_END_RANGE]
+    )
+    return hashlib.sha1(settings.encode("utf-8")).hexdigest()
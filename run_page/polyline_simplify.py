@@ -0,0 +1,143 @@
+"""
+Ramer-Douglas-Peucker simplification of tracks on NumPy arrays.
+Keeps the same points as gpxpy's simplify_polyline(), without its recursion.
+"""
+
+import math
+
+import numpy as np
+from gpxpy.geo import ONE_DEGREE, distance, haversine_distance
+
+# the same value gpxpy uses in simplify()
+SIMPLIFY_MAX_DISTANCE = 10  # m
+# NumPy may round a cosine differently than math does, distances this close
+# (relative) to max_distance are measured again the way gpxpy does
+TIE_MARGIN = 1e-6
+# open points below which simplify() goes on in plain Python
+SCALAR_POINTS = 1024
+
+
+def _distance_from_line(lat, lon, i, begin, end):
+    """Meters from point i to the line through begin and end, like gpxpy."""
+    a = distance(lat[begin], lon[begin], None, lat[end], lon[end], None)
+    b = distance(lat[begin], lon[begin], None, lat[i], lon[i], None)
+    if not a:
+        return b
+    c = distance(lat[end], lon[end], None, lat[i], lon[i], None)
+    s = (a + b + c) / 2.0
+    return 2.0 * math.sqrt(abs(s * (s - a) * (s - b) * (s - c))) / a
+
+
+def _simplify_stretches(lat, lon, stretches, max_distance, keep):
+    """Keep the points of stretches one after the other, in plain Python."""
+    stack = list(stretches)
+    while stack:
+        begin, end = stack.pop()
+        if end - begin < 2:
+            continue
+        lat_1, lon_1, lat_2, lon_2 = lat[begin], lon[begin], lat[end], lon[end]
+        if lon_1 == lon_2:
+            a, b, c = 0.0, 1.0, -lon_1
+        else:
+            slope = (lat_1 - lat_2) / (lon_1 - lon_2)
+            a, b, c = 1.0, -slope, -(lat_1 - lon_1 * slope)
+        max_d = 0
+        pos = begin + 1
+        for i in range(begin + 1, end):
+            d = abs(a * lat[i] + b * lon[i] + c)
+            if d > max_d:
+                max_d = d
+                pos = i
+        if not _distance_from_line(lat, lon, pos, begin, end) < max_distance:
+            keep[pos] = True
+            stack.append((pos, end))
+            stack.append((begin, pos))
+
+
+def _distances(lat_1, lon_1, lat_2, lon_2):
+    """gpxpy.geo.distance() of many pairs of points without elevation."""
+    x = lat_1 - lat_2
+    y = (lon_1 - lon_2) * np.cos(np.radians(lat_1))
+    distances = np.sqrt(x * x + y * y) * ONE_DEGREE
+    # points too distant for the flat approximation, rare enough to loop over
+    for i in np.flatnonzero((np.abs(x) > 0.2) | (np.abs(lon_1 - lon_2) > 0.2)):
+        distances[i] = haversine_distance(lat_1[i], lon_1[i], lat_2[i], lon_2[i])
+    return distances
+
+
+def _distances_from_lines(lat, lon, points, begins, ends):
+    """_distance_from_line() of many points and lines at once."""
+    starts = np.concatenate((begins, begins, ends))
+    stops = np.concatenate((ends, points, points))
+    a, b, c = _distances(lat[starts], lon[starts], lat[stops], lon[stops]).reshape(
+        3, -1
+    )
+    s = (a + b + c) / 2.0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        heights = 2.0 * np.sqrt(np.abs(s * (s - a) * (s - b) * (s - c))) / a
+    return np.where(a == 0, b, heights)
+
+
+def simplify(lat, lon, max_distance=SIMPLIFY_MAX_DISTANCE):
+    """Indices of the points gpxpy's simplify_polyline() keeps, in order.
+
+    Every point farther than max_distance meters from the simplified line is
+    kept. Instead of recursing into one stretch after the other, all open
+    stretches are split at once, which keeps the same points.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    n = len(lat)
+    if n < 3:
+        return np.arange(n)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, -1]] = True
+    begins = np.array([0])
+    ends = np.array([n - 1])
+    while True:
+        inner = ends - begins - 1
+        begins, ends, inner = begins[inner > 0], ends[inner > 0], inner[inner > 0]
+        if inner.sum() < SCALAR_POINTS:
+            # too few points left to make up for the NumPy calls of a round
+            _simplify_stretches(
+                lat.tolist(),
+                lon.tolist(),
+                zip(begins.tolist(), ends.tolist()),
+                max_distance,
+                keep,
+            )
+            break
+        # the points between begin and end of every stretch, one after the other
+        stretch = np.repeat(np.arange(len(begins)), inner)
+        starts = np.cumsum(inner) - inner
+        points = begins[stretch] + 1 + np.arange(len(stretch)) - starts[stretch]
+
+        # a "normal" line, not a spherical one, only finds the farthest point
+        lat_1, lon_1, lat_2, lon_2 = lat[begins], lon[begins], lat[ends], lon[ends]
+        vertical = lon_1 == lon_2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = (lat_1 - lat_2) / (lon_1 - lon_2)
+        a = np.where(vertical, 0.0, 1.0)
+        b = np.where(vertical, 1.0, -slope)
+        c = np.where(vertical, -lon_1, -(lat_1 - lon_1 * slope))
+        d = np.abs(a[stretch] * lat[points] + b[stretch] * lon[points] + c[stretch])
+        # the first point at the largest distance, as gpxpy takes it
+        farthest = np.flatnonzero(d == np.maximum.reduceat(d, starts)[stretch])
+        owners = stretch[farthest]
+        first = np.ones(len(farthest), dtype=bool)
+        first[1:] = owners[1:] != owners[:-1]
+        farthest = points[farthest[first]]
+
+        distances = _distances_from_lines(lat, lon, farthest, begins, ends)
+        ties = np.abs(distances - max_distance) <= TIE_MARGIN * max_distance
+        for i in np.flatnonzero(ties):
+            distances[i] = _distance_from_line(
+                lat, lon, farthest[i], begins[i], ends[i]
+            )
+        split = ~(distances < max_distance)
+        keep[farthest[split]] = True
+        begins, ends = (
+            np.concatenate((begins[split], farthest[split])),
+            np.concatenate((farthest[split], ends[split])),
+        )
+    return np.flatnonzero(keep)
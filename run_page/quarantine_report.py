@@ -0,0 +1,49 @@
+"""
+List the GPX/TCX/FIT files that failed to load and are skipped by later syncs
+"""
+
+import argparse
+import os
+
+from config import TRACK_QUARANTINE_FILE
+
+from gpxtrackposter.track_quarantine import TrackQuarantine
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--suffix",
+        choices=["gpx", "tcx", "fit"],
+        help="only list files of this type",
+    )
+    parser.add_argument(
+        "--release",
+        nargs="*",
+        metavar="FILE",
+        help="forget these files (all listed files when none given), the next sync parses them again",
+    )
+    options = parser.parse_args()
+
+    quarantine = TrackQuarantine(TRACK_QUARANTINE_FILE)
+    entries = {
+        path: entry
+        for path, entry in sorted(quarantine.entries.items())
+        if not options.suffix or entry["suffix"] == options.suffix
+    }
+    if options.release is not None:
+        file_names = options.release or [
+            os.path.join(quarantine.root_dir, path) for path in entries
+        ]
+        for file_name in file_names:
+            quarantine.release(file_name)
+        quarantine.save()
+        print(f"released {len(file_names)} file(s)")
+    else:
+        for path, entry in entries.items():
+            state = (
+                ""
+                if os.path.exists(os.path.join(quarantine.root_dir, path))
+                else " (missing)"
+            )
+            print(f"{path}{state}\n    {entry['size']} bytes, {entry['error']}")
+        print(f"{len(entries)} quarantined file(s)")
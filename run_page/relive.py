@@ -4,7 +4,6 @@ import requests
 from sqlalchemy import text
 from config import JSON_FILE, SQL_FILE
 from generator import Generator
-import json
 
 token = 'eyJhbGciOiJSUzI1NiIsInR5cCI6IkpXVCIsImtpZCI6Iml3cTVtSmZaaS1wLTM4QkstWE5rei1HZG1LayJ9.eyJhdWQiOiJhMjc0YjNjMy04ZTIxLTQxM2ItYTNhNy1jY2NkZDI1MTQxYzQiLCJleHAiOjE3NDE2Nzc3NDksImlhdCI6MTc0MTU5MTM0OSwiaXNzIjoicmVsaXZlLmNjIiwic3ViIjoiODgwZTdlOWItYWU5Ni00NWFmLWJlZjYtZmVlMzg1YmY2ZTAwIiwianRpIjoiMzBhYzYwMTAtYzNmMy00ODMzLWFkMjAtMDUwMTI3MzIzNTQwIiwiYXV0aGVudGljYXRpb25UeXBlIjoiUkVGUkVTSF9UT0tFTiIsImVtYWlsIjoiODM2MzIzNDkzQHFxLmNvbSIsImVtYWlsX3ZlcmlmaWVkIjp0cnVlLCJwcmVmZXJyZWRfdXNlcm5hbWUiOiJyZWxpdmUyMjg1NTAiLCJhcHBsaWNhdGlvbklkIjoiYTI3NGIzYzMtOGUyMS00MTNiLWEzYTctY2NjZGQyNTE0MWM0IiwidGlkIjoiODM4Njk0MjQtYWVhNS00Yzk5LWE3OTctZjEyNmFkZTYzNWNhIiwicm9sZXMiOltdLCJhdXRoX3RpbWUiOjE3NDE1ODg4NzIsInNpZCI6ImNiNzM0NTVlLWY1NjMtNDQ2OC05MWE1LWY0NWUwOWQyZWUwNyIsInVzZXJfaWQiOjIwMDA5ODg0fQ.imgqvoh6u4rseVVrAO1Ij_PMryAVa3QtGFFgDaVzxiae4ZnxwTZBmeyPNrKo-qa13U3L4UzUdvIfyd1yJsLn16CyoQ_nFc1MjKhnlC1YEnJmkJgH5jyQsj9xR98Qu8sNwfruNWjx2BRow4Z0wEgOyjjaOdy1GuNMRB_iv5bWdabRfTB22gsSyysKirBlGTqDF4JFihCMRfrz1P3CRGVbhG4yvHaXh0-O0uOgXb1IHoGISmjNFsbV-wJDbGFvJ3j2Qxqwq8GXLz3tloyI3j654v7xhFI5RSDnMos3KAqi6t9gxbCm44pRtDHwEZV9sH-BBquI8d4CDwBM5fevklWHpg'
 HEADERS = {
@@ -166,6 +165,4 @@ if __name__ == '__main__':
                 if video_url:
                     generator.update(text("UPDATE activities SET relive_url='" + share_url + "', video_url = '" + video_url + "' WHERE SUBSTR(start_date_local, 1, 16) = '" + created_at + "'"))
 
-        activities_list = generator.loadForMapping()
-        with open(JSON_FILE, "w") as f:
-            json.dump(activities_list, f, indent=0)
+        generator.write_activities_file(JSON_FILE, for_mapping=True)
@@ -0,0 +1,80 @@
+"""polyline_codec against the polyline package."""
+
+import random
+
+import numpy as np
+import polyline
+import pytest
+
+from polyline_codec import decode_coords, decode_many, encode_coords, encode_many
+
+
+def random_polylines(rng, count, digits=5):
+    polylines = []
+    for _ in range(count):
+        lat, lon = rng.uniform(-90, 90), rng.uniform(-180, 180)
+        points = []
+        for _ in range(rng.choice([0, 1, 2, rng.randint(3, 500)])):
+            points.append((round(lat, digits), round(lon, digits)))
+            lat = min(90.0, max(-90.0, lat + rng.uniform(-0.01, 0.01)))
+            lon = min(
+                180.0, max(-180.0, lon + rng.choice([-1, 1]) * rng.expovariate(100))
+            )
+        polylines.append(points)
+    return polylines
+
+
+def flatten(polylines):
+    coords = np.array([p for points in polylines for p in points], dtype=np.float64)
+    offsets = np.cumsum([0] + [len(points) for points in polylines])
+    return coords.reshape(-1, 2), offsets
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("precision", [5, 6])
+def test_encode_many(seed, precision):
+    polylines = random_polylines(random.Random(seed), 50, precision)
+    coords, offsets = flatten(polylines)
+    expected = [
+        polyline.encode(points, precision) if points else "" for points in polylines
+    ]
+    assert encode_many(coords, offsets, precision) == expected
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("precision", [5, 6])
+def test_decode_many(seed, precision):
+    polylines = random_polylines(random.Random(seed), 50, precision)
+    polyline_strs = [
+        polyline.encode(points, precision) if points else "" for points in polylines
+    ]
+    coords, offsets = decode_many(polyline_strs, precision)
+    expected = [polyline.decode(s, precision) if s else [] for s in polyline_strs]
+    assert offsets.tolist() == np.cumsum([0] + [len(p) for p in expected]).tolist()
+    assert list(map(tuple, coords.tolist())) == [
+        p for points in expected for p in points
+    ]
+
+
+def test_rounding_halves():
+    # the polyline package rounds half away from zero, as Python 2 did
+    points = [(0.000005, -0.000005), (0.000015, -0.000025), (-45.123455, 179.999995)]
+    assert encode_coords(*np.array(points).T) == polyline.encode(points)
+
+
+def test_empty():
+    assert encode_many(np.empty((0, 2)), [0]) == []
+    assert encode_many(np.empty((0, 2)), [0, 0, 0]) == ["", ""]
+    coords, offsets = decode_many([])
+    assert coords.shape == (0, 2) and offsets.tolist() == [0]
+    coords, offsets = decode_many(["", ""])
+    assert coords.shape == (0, 2) and offsets.tolist() == [0, 0, 0]
+    assert decode_coords("").shape == (0, 2)
+
+
+@pytest.mark.parametrize(
+    "polyline_str", ["_p~iF", "_p~iF~ps|U_ulL", "_p~iF~ps|U_", " @@"]
+)
+def test_decode_invalid(polyline_str):
+    with pytest.raises(ValueError):
+        decode_many(["_p~iF~ps|U", polyline_str])
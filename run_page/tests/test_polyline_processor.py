@@ -0,0 +1,164 @@
+"""filter_out() against the one point at a time filtering it replaced."""
+
+import random
+
+import numpy as np
+import polyline
+import pytest
+from haversine import haversine
+
+import polyline_processor
+from polyline_processor import (
+    _start_end_hiding,
+    filter_out,
+    haversine_np,
+    point_in_list_points_range,
+    start_end_hiding,
+)
+
+
+def reference_filter_out(polyline_str, ignore_polyline, ignore_range, start_end_range):
+    new_pl = _start_end_hiding(polyline.decode(polyline_str), start_end_range)
+    new_pl = [
+        point
+        for point in new_pl
+        if not point_in_list_points_range(point, ignore_polyline, ignore_range)
+    ]
+    if not new_pl:
+        return
+    return polyline.encode(new_pl)
+
+
+@pytest.fixture
+def privacy(monkeypatch):
+    """Set the IGNORE_* settings filter_out() reads, in km."""
+
+    def set_privacy(ignore_polyline, ignore_range, start_end_range):
+        monkeypatch.setattr(polyline_processor, "IGNORE_POLYLINE", ignore_polyline)
+        monkeypatch.setattr(polyline_processor, "IGNORE_RANGE", ignore_range)
+        monkeypatch.setattr(
+            polyline_processor, "IGNORE_START_END_RANGE", start_end_range
+        )
+
+    return set_privacy
+
+
+def random_track(rng, lat, lon, count, step=0.001):
+    """Random walk of count points, rounded as a decoded polyline is."""
+    track = []
+    for _ in range(count):
+        track.append((round(lat, 5), round((lon + 180) % 360 - 180, 5)))
+        lat = min(90.0, max(-90.0, lat + rng.uniform(-step, step)))
+        lon += rng.uniform(-step, step)
+    return track
+
+
+def near(rng, track, count, spread=0.002):
+    return [
+        (round(lat + rng.uniform(-spread, spread), 5), round(lon, 5))
+        for lat, lon in rng.sample(track, count)
+    ]
+
+
+def rounding_ties(count, seed=0):
+    """(point, center) pairs haversine_np() measures a bit off haversine()."""
+    rng = random.Random(seed)
+    ties = []
+    while len(ties) < count:
+        points = [
+            (round(rng.uniform(-80, 80), 5), round(rng.uniform(-179, 179), 5))
+            for _ in range(10000)
+        ]
+        centers = [
+            (
+                round(lat + rng.uniform(-0.01, 0.01), 5),
+                round(lon + rng.uniform(-0.01, 0.01), 5),
+            )
+            for lat, lon in points
+        ]
+        a, b = np.array(points), np.array(centers)
+        distances = haversine_np(a[:, 0], a[:, 1], b[:, 0], b[:, 1]).tolist()
+        ties.extend(
+            (point, center)
+            for point, center, distance in zip(points, centers, distances)
+            if haversine(point, center) != distance
+        )
+    return ties[:count]
+
+
+ROUNDING_TIES = rounding_ties(12)
+
+
+def assert_same(track, ignore_polyline, ignore_range, start_end_range):
+    polyline_str = polyline.encode(track)
+    assert filter_out(polyline_str) == reference_filter_out(
+        polyline_str, ignore_polyline, ignore_range, start_end_range
+    )
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize(
+    "lat, lon",
+    [
+        (39.9, 116.4),  # Beijing
+        (-33.9, 151.2),  # Sydney
+        (89.9, 0.0),  # close to the pole
+        (-89.95, 45.0),
+        (10.0, 179.99),  # across the antimeridian
+        (-20.0, -179.99),
+    ],
+)
+def test_random_tracks(privacy, seed, lat, lon):
+    rng = random.Random(seed)
+    track = random_track(rng, lat, lon, rng.randint(2, 400))
+    ignore_polyline = near(rng, track, rng.randint(1, 5))
+    ignore_range = rng.choice([0, 0.01, 0.05, 0.2, 1.0])
+    start_end_range = rng.choice([0, 0.05, 0.2, 0.5])
+    privacy(ignore_polyline, ignore_range, start_end_range)
+    assert_same(track, ignore_polyline, ignore_range, start_end_range)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_points_exactly_at_ignore_range(privacy, seed):
+    rng = random.Random(seed)
+    track = random_track(rng, 47.3, 8.5, 200)
+    center = rng.choice(track)
+    # every point at exactly that distance is kept, closer ones are left out
+    ignore_range = haversine(rng.choice(track), center)
+    privacy([center], ignore_range, 0)
+    assert_same(track, [center], ignore_range, 0)
+
+
+@pytest.mark.parametrize("point, center", ROUNDING_TIES)
+def test_ignore_range_rounded_differently(privacy, point, center):
+    # the point is exactly IGNORE_RANGE away, NumPy may find it a bit closer
+    track = [(point[0] - 0.001, point[1]), point, (point[0] + 0.001, point[1])]
+    ignore_range = haversine(point, center)
+    privacy([center], ignore_range, 0)
+    assert_same(track, [center], ignore_range, 0)
+
+
+@pytest.mark.parametrize("point, center", ROUNDING_TIES)
+def test_start_end_range_rounded_differently(point, center):
+    track = [center, point, (point[0] + 0.001, point[1]), (point[0] + 0.002, point[1])]
+    distance = haversine(point, center)
+    assert start_end_hiding(track, distance) == _start_end_hiding(track, distance)
+    track = track[::-1]
+    assert start_end_hiding(track, distance) == _start_end_hiding(track, distance)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_start_end_exactly_at_range(seed):
+    rng = random.Random(seed)
+    track = random_track(rng, 64.1, -21.9, 100)
+    # summed up the way _start_end_hiding() does it
+    distance = 0
+    for i in range(1, rng.randint(2, 99)):
+        distance += haversine(track[i], track[i - 1])
+    assert start_end_hiding(track, distance) == _start_end_hiding(track, distance)
+
+
+def test_empty_polylines(privacy):
+    privacy([], 0, 0)
+    assert filter_out("") is None
+    assert filter_out(None) is None
@@ -0,0 +1,75 @@
+"""simplify() against gpxpy's recursive simplify_polyline()."""
+
+import random
+
+import numpy as np
+import pytest
+from gpxpy.geo import Location, distance_from_line, simplify_polyline
+
+import polyline_simplify
+from polyline_simplify import SCALAR_POINTS, simplify
+
+
+def random_track(rng, count, step=0.0002, lon_digits=None):
+    """Random walk of count (lat, lon) points around Berlin."""
+    lat, lon = 52.5, 13.4
+    track = []
+    for _ in range(count):
+        track.append((lat, lon if lon_digits is None else round(lon, lon_digits)))
+        lat += rng.uniform(-step, step)
+        lon += rng.uniform(-step, step)
+    return track
+
+
+def assert_same(track, max_distance):
+    points = [Location(lat, lon) for lat, lon in track]
+    index = {id(point): i for i, point in enumerate(points)}
+    expected = [index[id(point)] for point in simplify_polyline(points, max_distance)]
+    lat, lon = zip(*track) if track else ((), ())
+    assert simplify(lat, lon, max_distance).tolist() == expected
+
+
+@pytest.mark.parametrize("count", [0, 1, 2, 3, 10, 500, SCALAR_POINTS + 1, 20000])
+@pytest.mark.parametrize("max_distance", [1, 10, 50])
+def test_random_tracks(count, max_distance):
+    rng = random.Random(count)
+    assert_same(random_track(rng, count), max_distance)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_vertical_lines(seed):
+    # longitudes on a grid, so many lines between two points are vertical
+    rng = random.Random(seed)
+    assert_same(random_track(rng, 5000, lon_digits=4), 10)
+    assert_same([(52.5 + i * 0.0001, 13.4) for i in range(3000)], 10)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_duplicate_points(seed):
+    rng = random.Random(seed)
+    track = [p for p in random_track(rng, 2000) for _ in range(rng.randint(1, 3))]
+    assert_same(track, 10)
+    # a round trip, the line from the first to the last point has no length
+    assert_same(track + track[::-1], 10)
+    assert_same([track[0]] * (SCALAR_POINTS + 5), 10)
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("rounding", [0, -1e-12, 1e-12])
+def test_distance_exactly_max_distance(monkeypatch, seed, rounding):
+    # a spike is the farthest point, a point exactly max_distance away is kept
+    # even when NumPy measures it a bit differently than gpxpy does
+    distances = polyline_simplify._distances
+    monkeypatch.setattr(
+        polyline_simplify,
+        "_distances",
+        lambda *args: distances(*args) * (1 + rounding),
+    )
+    rng = random.Random(seed)
+    track = random_track(rng, SCALAR_POINTS * 3, step=0.00001)
+    spike = rng.randrange(1, len(track) - 1)
+    track[spike] = (track[spike][0] + 0.01, track[spike][1] - 0.01)
+    points = [Location(lat, lon) for lat, lon in track]
+    max_distance = distance_from_line(points[spike], points[0], points[-1])
+    assert_same(track, max_distance)
+    assert spike in simplify(*np.array(track).T, max_distance)
@@ -0,0 +1,108 @@
+"""
+Distance, moving time, elevation gain and heart rate of a track on NumPy arrays.
+Distances follow gpxpy.geo.distance, so the numbers agree with gpxpy's own.
+"""
+
+import math
+
+import numpy as np
+from gpxpy.geo import ONE_DEGREE, haversine_distance
+
+# the same value gpxpy uses in get_moving_data()
+STOPPED_SPEED_THRESHOLD = 1  # km/h
+
+
+def _column(values):
+    """float64 array of values, None becomes NaN"""
+    if isinstance(values, np.ndarray):
+        return values.astype(np.float64, copy=False)
+    return np.array([math.nan if v is None else v for v in values], dtype=np.float64)
+
+
+def total(values):
+    """Sum from left to right, the same float as a Python loop adding them up."""
+    if not len(values):
+        return 0
+    return float(np.cumsum(values)[-1])
+
+
+def point_distances(lat, lon, ele=None):
+    """Meters from every point to the one before, like gpxpy.geo.distance.
+
+    An elevation of 0 or NaN counts as missing, as in gpxpy get_moving_data().
+    Returns len(lat) - 1 values.
+    """
+    lat, lon = _column(lat), _column(lon)
+    lat_1, lon_1, lat_2, lon_2 = lat[1:], lon[1:], lat[:-1], lon[:-1]
+    x = lat_1 - lat_2
+    y = (lon_1 - lon_2) * np.cos(np.radians(lat_1))
+    distances = np.sqrt(x * x + y * y) * ONE_DEGREE
+    if ele is not None:
+        ele = _column(ele)
+        ele_1, ele_2 = ele[1:], ele[:-1]
+        with np.errstate(invalid="ignore"):
+            use_ele = (ele_1 != 0) & (ele_2 != 0) & (ele_1 != ele_2)
+        use_ele &= ~(np.isnan(ele_1) | np.isnan(ele_2))
+        dz = ele_1[use_ele] - ele_2[use_ele]
+        distances[use_ele] = np.sqrt(distances[use_ele] ** 2 + dz * dz)
+    # points too distant for the flat approximation, rare enough to loop over
+    for i in np.flatnonzero((np.abs(x) > 0.2) | (np.abs(lon_1 - lon_2) > 0.2)):
+        distances[i] = haversine_distance(lat_1[i], lon_1[i], lat_2[i], lon_2[i])
+    return distances
+
+
+def length_2d(lat, lon):
+    """Same as gpxpy GPXTrackSegment.length_2d() of these points."""
+    return total(point_distances(lat, lon))
+
+
+def moving_data(distances, seconds, threshold=STOPPED_SPEED_THRESHOLD):
+    """(moving_time, stopped_time, moving_distance) like gpxpy get_moving_data().
+
+    distances, seconds: length and duration of every step, NaN when unknown.
+    A step slower than threshold km/h counts as stopped.
+    """
+    distances, seconds = _column(distances), _column(seconds)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        counted = (seconds > 0) & (distances != 0) & ~np.isnan(distances)
+        speed_kmh = (distances / 1000.0) / (seconds / 60.0**2)
+        stopped = counted & (speed_kmh <= threshold)
+    moving = counted & ~stopped
+    return (
+        float(total(seconds[moving])),
+        float(total(seconds[stopped])),
+        float(total(distances[moving])),
+    )
+
+
+def track_moving_data(lat, lon, time, ele=None, threshold=STOPPED_SPEED_THRESHOLD):
+    """moving_data() of points with time in seconds, NaN when unknown."""
+    time = _column(time)
+    return moving_data(point_distances(lat, lon, ele), np.diff(time), threshold)
+
+
+def elevation_gain_loss(ele):
+    """(uphill, downhill) like gpxpy calculate_uphill_downhill().
+
+    Missing elevations (None or NaN) are skipped, gpxpy would climb from 0 there.
+    """
+    ele = _column(ele)
+    if not len(ele):
+        return 0, 0
+    smoothed = ele.copy()
+    smoothed[1:-1] = ele[:-2] * 0.3 + ele[1:-1] * 0.4 + ele[2:] * 0.3
+    # a point next to a missing one is not smoothed
+    unsmoothed = np.isnan(smoothed)
+    smoothed[unsmoothed] = ele[unsmoothed]
+    d = np.diff(smoothed)
+    d = d[~np.isnan(d)]
+    return float(total(d[d > 0])), float(-total(d[d <= 0]))
+
+
+def heart_rate_stats(hr):
+    """(average, max) of the heart rates above 0, (None, None) without any."""
+    hr = _column(hr)
+    hr = hr[hr > 0]
+    if not len(hr):
+        return None, None
+    return total(hr) / len(hr), hr.max().item()
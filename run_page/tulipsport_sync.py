@@ -1,7 +1,6 @@
 import argparse
 import base64
 import hashlib
-import json
 import os
 import time
 import zlib
@@ -259,9 +258,7 @@ def sync_tulipsport_activites(token, with_gpx=False):
     new_tracks = get_new_activities(token, old_tracks_ids, with_gpx)
     generator.sync_from_app(new_tracks)
 
-    activities_list = generator.load()
-    with open(JSON_FILE, "w") as f:
-        json.dump(activities_list, f)
+    generator.write_activities_file(JSON_FILE, indent=None)
 
 
 if __name__ == "__main__":
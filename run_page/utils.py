@@ -1,4 +1,3 @@
-import json
 import time
 from datetime import datetime
 
@@ -65,17 +64,13 @@ def make_activities_file(
         merge_tracks=merge_tracks,
         only_after_latest=only_after_latest,
     )
-    activities_list = generator.load()
-    with open(json_file, "w") as f:
-        json.dump(activities_list, f, indent=0)
+    generator.write_activities_file(json_file)
 
 
 def make_activities_file_only(sql_file, data_dir, json_file, file_suffix="gpx"):
     generator = Generator(sql_file)
     generator.sync_from_data_dir(data_dir, file_suffix=file_suffix)
-    activities_list = generator.loadForMapping()
-    with open(json_file, "w") as f:
-        json.dump(activities_list, f, indent=0)
+    generator.write_activities_file(json_file, for_mapping=True)
 
 
 def make_strava_client(client_id, client_secret, refresh_token):
@@ -197,9 +197,9 @@ if __name__ == "__main__":
         x.login_by_password()
 
     generator = Generator(SQL_FILE)
-    old_tracks_ids = generator.get_old_tracks_ids()
     tracks = x.get_old_tracks()
-    new_tracks = [i for i in tracks if str(i["id"]) not in old_tracks_ids]
+    known = generator.contains_many([i["id"] for i in tracks])
+    new_tracks = [i for i, saved in zip(tracks, known) if not saved]
 
     print(f"{len(new_tracks)} new activities to be downloaded")
 